@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 
 class APIConfig(AppConfig):
     name = 'api'
     verbose_name = 'API'
+
+    def ready(self):
+        from api import genres, instrumentation, routing, sqlite
+        connection_created.connect(sqlite.apply_pragmas)
+        connection_created.connect(instrumentation.install_query_recorder)
+        connection_created.connect(routing.install_replica_query_recorder)
+        post_save.connect(genres.invalidate_registry, sender='api.Genre')
+        post_delete.connect(genres.invalidate_registry, sender='api.Genre')
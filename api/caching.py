@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import hashlib
+import time
+import uuid
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_date
+from api import routing
+
+CACHE_ALIAS = 'responses'
+
+
+def is_enabled() -> bool:
+    return CACHE_ALIAS in settings.CACHES
+
+
+def new_generation() -> str:
+    # prefixed with the time it started, see started_recently
+    return f'{time.time()}:{uuid.uuid4().hex}'
+
+
+def started_recently(generations: Iterable[str], seconds: float) -> bool:
+    """Determine whether any of the generations started within the last seconds."""
+    threshold = time.time() - seconds
+    for generation in generations:
+        start, separator, _ = generation.partition(':')
+        if separator and float(start) > threshold:
+            return True
+    return False
+
+
+def get_generations(scopes: Iterable[str]) -> List[str]:
+    """Get the current generation of each scope, starting a new one for scopes without any.
+
+    Cached responses are keyed on the generations of the scopes they depend on, so that starting a new generation
+    of a scope invalidates exactly the responses depending on it.
+    """
+    cache = caches[CACHE_ALIAS]
+    keys = [f'generation:{scope}' for scope in ['all', *scopes]]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # a fresh generation rather than a counter, so that an evicted generation can never come back
+            cache.add(key, new_generation(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def invalidate(*scopes: str):
+    """Invalidate cached responses depending on any of the scopes, once the current transaction commits."""
+    if not is_enabled():
+        return
+
+    def start_new_generations():
+        caches[CACHE_ALIAS].set_many({f'generation:{scope}': new_generation() for scope in scopes}, None)
+
+    transaction.on_commit(start_new_generations)
+
+
+def invalidate_movies():
+    invalidate('movies')
+
+
+def invalidate_comments(movie_ids: Iterable[int]):
+    invalidate('comments', *(f'comments:{movie_id}' for movie_id in set(movie_ids)))
+
+
+def invalidate_all():
+    invalidate('all')
+
+
+def generate_etag(content: bytes) -> str:
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def is_not_modified(etag: str, if_none_match: str) -> bool:
+    return etag in (tag.strip() for tag in if_none_match.split(','))
+
+
+def generate_response(content: bytes, content_type: str, etag: str, if_none_match: str) -> HttpResponse:
+    if is_not_modified(etag, if_none_match):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    return response
+
+
+def cache_response(get_scopes: Callable[..., Optional[List[str]]], skip_if: Optional[Callable[..., Any]] = None):
+    """Cache the successful GET responses of the view, and answer If-None-Match revalidations with 304s.
+
+    get_scopes is given the request and returns the scopes (see invalidate) the response depends on,
+    or None if it must not be cached. Requests for which skip_if returns a truthy value, such as those asking for
+    another representation through the Accept header, bypass the cache, and responses are sent with Vary: Accept.
+    Responses read from a replica within READ_YOUR_WRITES_WINDOW of an invalidation aren't cached.
+    Async views are supported too, with cache access off the event loop.
+    """
+    def decorator(view):
+        def get_cached_response(request) -> Tuple[Optional[str], Optional[HttpResponse]]:
+            """Get the cache key of the response to the request (None if uncacheable) and the cached response."""
+            if not is_enabled() or (skip_if is not None and skip_if(request)):
+                return None, None
+            scopes = get_scopes(request)
+            if scopes is None:
+                return None, None
+            normalized_params = '&'.join(
+                f'{key}={" ".join(str(value).split())}' for key, value in sorted(request.GET.items())
+            )
+            generations = get_generations(scopes)
+            key_material = '|'.join([view.__name__, normalized_params, *generations])
+            key = f'response:{hashlib.md5(key_material.encode()).hexdigest()}'
+            cached = caches[CACHE_ALIAS].get(key)
+            if cached is not None:
+                return key, vary(generate_response(*cached, request.META.get('HTTP_IF_NONE_MATCH', '')))
+            if routing.reads_from_replica() and started_recently(generations, settings.READ_YOUR_WRITES_WINDOW):
+                # the replica may not have caught up with the writes which invalidated the scopes yet, so its response
+                # is served but not cached, or it would be served to clients reading their writes from the primary
+                return None, None
+            return key, None
+
+        def vary(response: HttpResponse) -> HttpResponse:
+            if skip_if is not None:
+                patch_vary_headers(response, ['Accept'])
+            return response
+
+        def cache_fresh_response(request, key: Optional[str], response: HttpResponse) -> HttpResponse:
+            vary(response)
+            if response.status_code != 200 or response.streaming:
+                return response
+            etag = generate_etag(response.content)
+            if key is not None:
+                caches[CACHE_ALIAS].set(
+                    key, (response.content, response['Content-Type'], etag), settings.RESPONSE_CACHE_TIMEOUT
+                )
+            if is_not_modified(etag, request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return vary(response)
+
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method != 'GET':
+                    return await view(request, *args, **kwargs)
+                key, cached_response = await sync_to_async(get_cached_response)(request)
+                if cached_response is not None:
+                    return cached_response
+                response = await view(request, *args, **kwargs)
+                return await sync_to_async(cache_fresh_response)(request, key, response)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+            key, cached_response = get_cached_response(request)
+            if cached_response is not None:
+                return cached_response
+            return cache_fresh_response(request, key, view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def get_movies_scopes(request) -> Optional[List[str]]:
+    return ['movies']
+
+
+def get_comments_scopes(request) -> Optional[List[str]]:
+    if request.GET.get('movie_id'):
+        try:
+            return [f'comments:{int(request.GET["movie_id"])}']
+        except ValueError:
+            return None
+    return ['comments']
+
+
+def get_top_scopes(request) -> Optional[List[str]]:
+    try:
+        start_date = parse_date(request.GET.get('start_date', ''))
+        end_date = parse_date(request.GET.get('end_date', ''))
+    except ValueError:
+        return None
+    if start_date is None or end_date is None:
+        # the view responds with an error, not worth caching
+        return None
+    # new comments are created now, so they only change rankings of periods which include today
+    if start_date <= timezone.now().date() <= end_date:
+        return ['movies', 'comments']
+    return ['movies']
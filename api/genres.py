@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+# TMDb's genres as of bundling, so that migrating needs no network access – sync_genres picks up later changes
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'genres.json')
+# minimum seconds between reloads caused by TMDb genre IDs which aren't known, as TMDb may have genres we don't
+MISS_REFRESH_INTERVAL = 60
+
+
+def load_fixture() -> List[dict]:
+    """Get the bundled genres, in the same form as tmdb.fetch_genres."""
+    with open(FIXTURE_PATH) as fixture_file:
+        return [{'id': entry['pk'], 'name': entry['fields']['name']} for entry in json.load(fixture_file)]
+
+
+class GenreRegistry:
+    """All genres, loaded once into memory, as they almost never change.
+
+    The registry is reloaded after max_age seconds, after genres are saved or deleted in this process, and when asked
+    about a genre it doesn't know.
+    """
+
+    def __init__(self, max_age: float = 3600, clock: Callable[[], float] = time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self._genres: Optional[Dict[int, dict]] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[int, dict]:
+        # imported here, as the models resolve genres through the registry
+        from api.models import Genre
+        with self._lock:
+            self._genres = {genre_id: {'id': genre_id, 'name': name} for genre_id, name in (
+                Genre.objects.values_list('id', 'name')
+            )}
+            self._loaded_at = self.clock()
+            return self._genres
+
+    def invalidate(self):
+        self._genres = None
+
+    def get_genres(self) -> Dict[int, dict]:
+        """Get the dict of every genre by ID, loading them if needed."""
+        genres = self._genres
+        if genres is None or self.clock() - self._loaded_at >= self.max_age:
+            genres = self.load()
+        return genres
+
+    def get_dicts(self, genre_ids: Iterable[int]) -> List[dict]:
+        """Get the dicts of existing genres, in the given order.
+
+        The dicts are shared, so they must not be modified. IDs come from the database, so a missing one means the
+        registry is out of date.
+        """
+        genre_ids = list(genre_ids)
+        genres = self.get_genres()
+        if any(genre_id not in genres for genre_id in genre_ids):
+            genres = self.load()
+        return [genres[genre_id] for genre_id in genre_ids if genre_id in genres]
+
+    def get_known_ids(self, genre_ids: Iterable[int]) -> Set[int]:
+        """Get the IDs of existing genres among TMDb genre IDs."""
+        genre_ids = set(genre_ids)
+        genres = self.get_genres()
+        if not genre_ids <= genres.keys() and self.clock() - self._loaded_at >= MISS_REFRESH_INTERVAL:
+            genres = self.load()
+        return genre_ids & genres.keys()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> GenreRegistry:
+    """Get the genre registry of this process, configured in the GENRE_REGISTRY_MAX_AGE setting."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = GenreRegistry(settings.GENRE_REGISTRY_MAX_AGE)
+    return _registry
+
+
+def reset_registry():
+    """Drop the genre registry, so that it gets rebuilt from settings and reloaded on next use."""
+    global _registry
+    with _registry_lock:
+        _registry = None
+
+
+def invalidate_registry(sender=None, using: str = DEFAULT_DB_ALIAS, **kwargs):
+    """post_save/post_delete receiver reloading the registry on next use, both now and once the change commits."""
+    registry = _registry
+    if registry is not None:
+        # now for reads within the transaction, and on commit in case another thread reloaded in the meantime
+        registry.invalidate()
+        transaction.on_commit(registry.invalidate, using=using)
@@ -0,0 +1,190 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Set, Tuple
+from django.conf import settings
+from django.db import close_old_connections
+from api.models import Movie, Comment
+
+logger = logging.getLogger(__name__)
+
+INGESTION_MODES = ('direct', 'deferred', 'group_commit')
+
+_STOP = object()
+
+
+class QueueFullError(Exception):
+    """The comment queue stayed full for longer than the enqueue timeout."""
+
+
+class IngesterStoppedError(Exception):
+    """The ingester is shutting down and no longer accepts comments."""
+
+
+class KnownMovieIds:
+    """IDs of movies known to exist, loaded on first use, so that comments can be validated without a query.
+
+    IDs missing from the set are checked in the database, as other processes may have added the movie since.
+    """
+
+    def __init__(self, using: str = 'default'):
+        self.using = using
+        self._ids: Optional[Set[int]] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, movie_id: int) -> bool:
+        if self._ids is None:
+            with self._lock:
+                if self._ids is None:
+                    self._ids = set(Movie.objects.using(self.using).values_list('id', flat=True))
+        if movie_id in self._ids:
+            return True
+        if Movie.objects.using(self.using).filter(id=movie_id).exists():
+            self._ids.add(movie_id)
+            return True
+        return False
+
+
+class CommentIngester:
+    """Writes comments from a bounded queue in batches, each in a single transaction (group commit).
+
+    A batch is written once max_batch_size comments are queued or max_delay seconds after its first comment,
+    whichever comes first, by a single flusher thread. Submitting blocks for up to enqueue_timeout seconds while
+    the queue is full, so that a comment storm slows clients down rather than exhausting memory.
+    """
+
+    def __init__(
+            self, max_batch_size: int = 500, max_delay: float = 0.05, queue_size: int = 10000,
+            enqueue_timeout: float = 1, using: str = 'default'
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.enqueue_timeout = enqueue_timeout
+        self.using = using
+        self.known_movie_ids = KnownMovieIds(using)
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stopped = False
+        # submissions between checking that the ingester isn't stopped and queuing their comment, which stop waits for
+        # so that no comment gets queued once the flusher is done
+        self._pending_submissions = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self.run, name='comment-ingester', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, movie_id: int, text: str) -> Future:
+        """Queue a comment, returning a future resolving to it once it is committed."""
+        with self._condition:
+            if self._stopped:
+                raise IngesterStoppedError('the comment ingester is shutting down')
+            self._pending_submissions += 1
+        future = Future()
+        try:
+            self._queue.put((Comment(movie_id=movie_id, text=text), future), timeout=self.enqueue_timeout)
+        except queue.Full:
+            raise QueueFullError(f'the comment queue is full ({self._queue.maxsize} comments)')
+        finally:
+            with self._condition:
+                self._pending_submissions -= 1
+                self._condition.notify_all()
+        return future
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop accepting comments and wait for the queued ones to be written."""
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._condition.wait_for(lambda: not self._pending_submissions)
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def get_batch(self) -> Tuple[List[Tuple[Comment, Future]], bool]:
+        """Wait for the next batch, returning it and whether the ingester was stopped."""
+        batch = []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                return batch, False
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self.get_batch()
+            if batch:
+                self.write(batch)
+        # comments submitted while stopping
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(batch), self.max_batch_size):
+            self.write(batch[start:start + self.max_batch_size])
+
+    def write(self, batch: List[Tuple[Comment, Future]]):
+        try:
+            Comment.objects.db_manager(self.using).ingest([comment for comment, _ in batch])
+        except Exception:
+            logger.exception('Writing a batch of %d comments failed, writing them one by one', len(batch))
+            # so that a single bad comment doesn't fail the whole batch
+            for comment, future in batch:
+                try:
+                    Comment.objects.db_manager(self.using).ingest([comment])
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(comment)
+        else:
+            for comment, future in batch:
+                future.set_result(comment)
+        finally:
+            close_old_connections()
+
+
+_ingester = None
+_ingester_lock = threading.Lock()
+
+
+def get_ingester() -> CommentIngester:
+    """Get the comment ingester configured in the COMMENT_INGESTION setting, started on first use.
+
+    Queued comments are flushed when the process exits.
+    """
+    global _ingester
+    if _ingester is None:
+        with _ingester_lock:
+            if _ingester is None:
+                config = settings.COMMENT_INGESTION
+                if config['MODE'] not in INGESTION_MODES:
+                    raise ValueError(f'unknown comment ingestion mode {config["MODE"]!r}')
+                ingester = CommentIngester(
+                    config['MAX_BATCH_SIZE'], config['MAX_DELAY'], config['QUEUE_SIZE'], config['ENQUEUE_TIMEOUT']
+                )
+                ingester.start()
+                atexit.register(ingester.stop, config['SHUTDOWN_TIMEOUT'])
+                _ingester = ingester
+    return _ingester
+
+
+def reset_ingester():
+    """Stop the comment ingester after flushing it, so that it gets rebuilt from settings on next use."""
+    global _ingester
+    with _ingester_lock:
+        if _ingester is not None:
+            _ingester.stop()
+            atexit.unregister(_ingester.stop)
+            _ingester = None
@@ -0,0 +1,210 @@
+import bisect
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse as DjangoJsonResponse
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram, labelled with a fixed set of label names."""
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, with +Inf last, sum)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            counts, total = self._series.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label_values: (list(counts), total[0]) for label_values, (counts, total) in self._series.items()}
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            cumulative_count = 0
+            for bound, count in zip([*self.buckets, '+Inf'], counts):
+                cumulative_count += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative_count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative_count}')
+        return lines
+
+
+# aggregated per process, as Prometheus scrapes each worker process separately
+HISTOGRAMS = {
+    'request': Histogram(
+        'movieproxy_request_duration_seconds', 'Time spent handling requests.', ('view', 'method', 'status'),
+        DURATION_BUCKETS
+    ),
+    'db': Histogram(
+        'movieproxy_db_duration_seconds', 'Time spent on database queries per sampled request.', ('view',),
+        DURATION_BUCKETS
+    ),
+    'db_queries': Histogram(
+        'movieproxy_db_queries', 'Database queries per sampled request.', ('view',), COUNT_BUCKETS
+    ),
+    'tmdb': Histogram(
+        'movieproxy_tmdb_duration_seconds', 'Time spent on TMDb calls per sampled request.', ('view',),
+        DURATION_BUCKETS
+    ),
+    'tmdb_calls': Histogram(
+        'movieproxy_tmdb_calls', 'TMDb calls per sampled request.', ('view',), COUNT_BUCKETS
+    ),
+    'json': Histogram(
+        'movieproxy_json_encode_duration_seconds', 'Time spent encoding JSON per sampled request.', ('view',),
+        DURATION_BUCKETS
+    )
+}
+
+
+class Recorder:
+    """Counts and times the work of a single request, by kind: db, tmdb or json."""
+
+    def __init__(self):
+        self.counts = {'db': 0, 'tmdb': 0, 'json': 0}
+        self.durations = {'db': 0.0, 'tmdb': 0.0, 'json': 0.0}
+
+    def record(self, kind: str, duration: float):
+        self.counts[kind] += 1
+        self.durations[kind] += duration
+
+
+# set only for sampled requests, and inherited by the threads sync_to_async runs their sync code in
+_recorder: contextvars.ContextVar[Optional[Recorder]] = contextvars.ContextVar('recorder', default=None)
+
+
+def record(kind: str, duration: float):
+    """Record duration seconds of work of the given kind for the current request, if it is sampled."""
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record(kind, duration)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper recording the time of every query."""
+    if _recorder.get() is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record('db', time.perf_counter() - start)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver installing record_query on every new database connection."""
+    connection.execute_wrappers.append(record_query)
+
+
+class JsonResponse(DjangoJsonResponse):
+    """JsonResponse recording the time spent encoding its data."""
+
+    def __init__(self, *args, **kwargs):
+        if _recorder.get() is None:
+            super().__init__(*args, **kwargs)
+            return
+        start = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        record('json', time.perf_counter() - start)
+
+
+def get_view_name(request) -> str:
+    # the URL name rather than the path, so that the number of series stays bounded
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return 'unresolved'
+    return resolver_match.url_name or 'unnamed'
+
+
+def finish(request, response: HttpResponse, recorder: Optional[Recorder], duration: float) -> HttpResponse:
+    view_name = get_view_name(request)
+    HISTOGRAMS['request'].observe(duration, view_name, request.method, str(response.status_code))
+    if recorder is None:
+        return response
+    for kind in ('db', 'tmdb', 'json'):
+        HISTOGRAMS[kind].observe(recorder.durations[kind], view_name)
+    HISTOGRAMS['db_queries'].observe(recorder.counts['db'], view_name)
+    HISTOGRAMS['tmdb_calls'].observe(recorder.counts['tmdb'], view_name)
+    response['Server-Timing'] = ', '.join([
+        f'total;dur={duration * 1000:.1f}',
+        f'db;dur={recorder.durations["db"] * 1000:.1f};desc="{recorder.counts["db"]} queries"',
+        f'tmdb;dur={recorder.durations["tmdb"] * 1000:.1f};desc="{recorder.counts["tmdb"]} calls"',
+        f'json;dur={recorder.durations["json"] * 1000:.1f}'
+    ])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({
+            'event': 'request', 'view': view_name, 'method': request.method, 'path': request.path,
+            'status': response.status_code, 'duration_ms': round(duration * 1000, 3),
+            'db_queries': recorder.counts['db'], 'db_ms': round(recorder.durations['db'] * 1000, 3),
+            'tmdb_calls': recorder.counts['tmdb'], 'tmdb_ms': round(recorder.durations['tmdb'] * 1000, 3),
+            'json_ms': round(recorder.durations['json'] * 1000, 3)
+        }))
+    return response
+
+
+class InstrumentationMiddleware:
+    """Times every request into the request duration histogram, and breaks sampled requests down further.
+
+    A share of INSTRUMENTATION_SAMPLE_RATE requests is sampled. Their database, TMDb and JSON encoding counts and
+    times go into histograms, a Server-Timing header and a structured log line. Streamed content isn't timed.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def start(self) -> Tuple[Optional[Recorder], Optional[contextvars.Token], float]:
+        recorder = Recorder() if random.random() < settings.INSTRUMENTATION_SAMPLE_RATE else None
+        token = _recorder.set(recorder) if recorder is not None else None
+        return recorder, token, time.perf_counter()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _recorder.reset(token)
+        return finish(request, response, recorder, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        recorder, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _recorder.reset(token)
+        return finish(request, response, recorder, time.perf_counter() - start)
+
+
+def render_metrics() -> str:
+    """Render all histograms in the Prometheus text exposition format."""
+    return '\n'.join(line for histogram in HISTOGRAMS.values() for line in histogram.render()) + '\n'
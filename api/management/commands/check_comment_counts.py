@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.models import CommentDailyCount
+
+
+class Command(BaseCommand):
+    help = 'Check that the daily comment count rollup agrees with the Comment table.'
+
+    def handle(self, *args, **options):
+        inconsistencies = CommentDailyCount.objects.find_inconsistencies()
+        for movie_id, day, expected_count, actual_count in inconsistencies:
+            self.stdout.write(f'Movie {movie_id} on {day}: {expected_count} comments, rollup says {actual_count}')
+        if inconsistencies:
+            raise CommandError(
+                f'{len(inconsistencies)} inconsistent daily comment count rows, run rebuild_comment_counts to fix'
+            )
+        self.stdout.write(self.style.SUCCESS('Daily comment counts are consistent'))
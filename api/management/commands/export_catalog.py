@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Export genres, movies and optionally comments to a compressed snapshot, to bootstrap other databases with.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file', help='path of the snapshot to write (gzip-compressed JSON lines), - for standard output'
+        )
+        parser.add_argument('--comments', action='store_true', help='include comments')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='number of rows read at once')
+
+    def handle(self, *args, **options):
+        try:
+            with snapshots.open_snapshot(options['file'], 'w') as snapshot:
+                counts = snapshots.export_catalog(snapshot, options['comments'], options['chunk_size'])
+        except OSError as e:
+            raise CommandError(f'Could not write snapshot: {e}')
+        # the snapshot itself may be going to standard output
+        self.stderr.write(self.style.SUCCESS(
+            f'Exported {counts["genre"]} genres, {counts["movie"]} movies and {counts["comment"]} comments'
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Import a snapshot written by export_catalog into a database without movies or comments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='path of the snapshot to read, - for standard input')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='number of rows inserted at once')
+
+    def handle(self, *args, **options):
+        try:
+            with snapshots.open_snapshot(options['file'], 'r') as snapshot:
+                counts = snapshots.import_catalog(snapshot, options['chunk_size'])
+        except OSError as e:
+            raise CommandError(f'Could not read snapshot: {e}')
+        except snapshots.SnapshotError as e:
+            raise CommandError(f'Could not import snapshot: {e}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {counts["genres"]} genres, {counts["movies"]} movies and {counts["comments"]} comments'
+        ))
@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from api.models import Movie
+
+
+class Command(BaseCommand):
+    help = 'Import movies from TMDb, given a file with one title per line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='path of the file with titles, - for standard input')
+        parser.add_argument('--workers', type=int, default=8, help='number of concurrent TMDb lookups')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='number of titles imported at once')
+
+    def handle(self, *args, **options):
+        try:
+            if options['file'] == '-':
+                titles = sys.stdin.read().splitlines()
+            else:
+                with open(options['file'], encoding='utf-8') as titles_file:
+                    titles = titles_file.read().splitlines()
+        except OSError as e:
+            raise CommandError(f'Could not read titles: {e}')
+        status_counts = {}
+        for start in range(0, len(titles), options['chunk_size']):
+            report = Movie.objects.bulk_update_or_create_from_tmdb(
+                titles[start:start + options['chunk_size']], max_workers=options['workers']
+            )
+            for title_report in report:
+                status_counts[title_report['status']] = status_counts.get(title_report['status'], 0) + 1
+                if options['verbosity'] > 1 or title_report['status'] not in ('created', 'updated'):
+                    self.stdout.write(f'{title_report["status"]}: {title_report["title"]}')
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{count} {status}' for status, count in sorted(status_counts.items())) or 'Nothing to import'
+        ))
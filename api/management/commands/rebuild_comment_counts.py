@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api.models import CommentDailyCount
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily comment count rollup from scratch.'
+
+    def handle(self, *args, **options):
+        rollup_row_count = CommentDailyCount.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rollup_row_count} daily comment count rows'))
@@ -0,0 +1,54 @@
+import datetime as dt
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.models import Movie
+from api.tmdb import RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Keep TMDb stats of movies fresh, refreshing the stalest movies first within a TMDb request budget.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='number of movies refreshed per batch')
+        parser.add_argument(
+            '--budget', type=float, default=300, help='maximum TMDb requests per minute, spread out evenly'
+        )
+        parser.add_argument(
+            '--max-age', type=float, default=24, help='hours after which movie stats are considered stale'
+        )
+        parser.add_argument(
+            '--idle-interval', type=float, default=60, help='seconds to wait when no movies are stale'
+        )
+        parser.add_argument('--once', action='store_true', help='exit once no movies are stale')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            self.stdout.write('Stopping after the current batch…')
+            stop.set()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        rate_limiter = RateLimiter(options['budget'] / 60)
+        max_age = dt.timedelta(hours=options['max_age'])
+
+        def before_fetch() -> bool:
+            return not stop.is_set() and not stop.wait(rate_limiter.reserve())
+
+        while not stop.is_set():
+            close_old_connections()
+            stale_movies = list(Movie.objects.stale(max_age)[:options['batch_size']])
+            if not stale_movies:
+                if options['once']:
+                    break
+                stop.wait(options['idle_interval'])
+                continue
+            refreshed_count, changed_count = Movie.objects.refresh_from_tmdb(stale_movies, before_fetch)
+            self.stdout.write(f'Refreshed {refreshed_count} movies, {changed_count} of which changed')
+            if not refreshed_count and options['once']:
+                # TMDb is failing, so the same movies would come up again
+                break
+        self.stdout.write(self.style.SUCCESS('Stopped'))
@@ -0,0 +1,42 @@
+import signal
+import threading
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from api.models import Genre
+from api.tmdb import TMDbError
+
+
+class Command(BaseCommand):
+    help = 'Sync genres with TMDb, adding new genres and renaming changed ones, once or periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=0, help='hours between syncs, syncing once and exiting if 0'
+        )
+
+    def handle(self, *args, **options):
+        if not options['interval']:
+            try:
+                added_count, renamed_count = Genre.objects.sync_from_tmdb()
+            except TMDbError as e:
+                raise CommandError(f'Syncing genres failed: {e}')
+            self.stdout.write(self.style.SUCCESS(f'Added {added_count} genres and renamed {renamed_count}'))
+            return
+
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        while not stop.is_set():
+            close_old_connections()
+            try:
+                added_count, renamed_count = Genre.objects.sync_from_tmdb()
+            except TMDbError as e:
+                self.stderr.write(f'Syncing genres failed: {e}')
+            else:
+                self.stdout.write(f'Added {added_count} genres and renamed {renamed_count}')
+            stop.wait(options['interval'] * 60 * 60)
+        self.stdout.write(self.style.SUCCESS('Stopped'))
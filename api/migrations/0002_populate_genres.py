@@ -1,13 +1,13 @@
 # Generated by Django 2.2.3 on 2019-07-09 09:08
 
 from django.db import migrations
-from api import tmdb
+from api import genres
 
 
 def populate_genres(apps, schema_editor):
     Genre = apps.get_model('api', 'Genre')
-    genres = tmdb.fetch_genres()
-    Genre.objects.bulk_create([Genre(**genre) for genre in genres], ignore_conflicts=True)
+    # the bundled genres rather than TMDb's, so that migrating works offline – sync_genres catches up with TMDb
+    Genre.objects.bulk_create([Genre(**genre) for genre in genres.load_fixture()], ignore_conflicts=True)
 
 
 def clear_genres(apps, schema_editor):
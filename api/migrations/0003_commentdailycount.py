@@ -0,0 +1,37 @@
+import datetime as dt
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def populate_comment_daily_counts(apps, schema_editor):
+    Comment = apps.get_model('api', 'Comment')
+    CommentDailyCount = apps.get_model('api', 'CommentDailyCount')
+    daily_counts = Comment.objects.annotate(
+        day=TruncDate('created_at', tzinfo=dt.timezone.utc)
+    ).values('movie_id', 'day').annotate(count=models.Count('id')).order_by()
+    CommentDailyCount.objects.bulk_create([CommentDailyCount(**row) for row in daily_counts], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_populate_genres')
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentDailyCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('movie', models.ForeignKey(
+                    on_delete=models.deletion.CASCADE, related_name='daily_comment_counts', to='api.Movie'
+                ))
+            ],
+            options={
+                'unique_together': {('movie', 'day')}
+            }
+        ),
+        migrations.RunPython(populate_comment_daily_counts, migrations.RunPython.noop)
+    ]
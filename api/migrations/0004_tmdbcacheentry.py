@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_commentdailycount')
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TMDbCacheEntry',
+            fields=[
+                ('key', models.CharField(max_length=1000, primary_key=True, serialize=False)),
+                ('value', models.JSONField(null=True)),
+                ('expires_at', models.DateTimeField(db_index=True))
+            ]
+        )
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_tmdbcacheentry')
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='fetched_at',
+            field=models.DateTimeField(db_index=True, null=True)
+        )
+    ]
@@ -0,0 +1,82 @@
+import sqlite3
+from django.db import migrations
+
+POSTGRESQL_FORWARDS = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    # the same expressions as Django's case-insensitive lookups, so that icontains/istartswith can use them too
+    'CREATE INDEX IF NOT EXISTS api_movie_title_trgm ON api_movie USING gin (UPPER(title::text) gin_trgm_ops)',
+    (
+        'CREATE INDEX IF NOT EXISTS api_movie_original_title_trgm '
+        'ON api_movie USING gin (UPPER(original_title::text) gin_trgm_ops)'
+    )
+]
+
+POSTGRESQL_BACKWARDS = [
+    'DROP INDEX IF EXISTS api_movie_title_trgm',
+    'DROP INDEX IF EXISTS api_movie_original_title_trgm'
+]
+
+SQLITE_FORWARDS = [
+    (
+        'CREATE VIRTUAL TABLE api_movie_search USING fts5('
+        "title, original_title, content='api_movie', content_rowid='id', tokenize='trigram')"
+    ),
+    (
+        'CREATE TRIGGER api_movie_search_insert AFTER INSERT ON api_movie BEGIN '
+        'INSERT INTO api_movie_search(rowid, title, original_title) VALUES (new.id, new.title, new.original_title); '
+        'END'
+    ),
+    (
+        'CREATE TRIGGER api_movie_search_delete AFTER DELETE ON api_movie BEGIN '
+        "INSERT INTO api_movie_search(api_movie_search, rowid, title, original_title) "
+        "VALUES ('delete', old.id, old.title, old.original_title); "
+        'END'
+    ),
+    (
+        'CREATE TRIGGER api_movie_search_update AFTER UPDATE OF title, original_title ON api_movie BEGIN '
+        "INSERT INTO api_movie_search(api_movie_search, rowid, title, original_title) "
+        "VALUES ('delete', old.id, old.title, old.original_title); "
+        'INSERT INTO api_movie_search(rowid, title, original_title) VALUES (new.id, new.title, new.original_title); '
+        'END'
+    ),
+    "INSERT INTO api_movie_search(api_movie_search) VALUES ('rebuild')"
+]
+
+SQLITE_BACKWARDS = [
+    'DROP TRIGGER IF EXISTS api_movie_search_insert',
+    'DROP TRIGGER IF EXISTS api_movie_search_delete',
+    'DROP TRIGGER IF EXISTS api_movie_search_update',
+    'DROP TABLE IF EXISTS api_movie_search'
+]
+
+
+def run_statements(schema_editor, postgresql_statements, sqlite_statements):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        statements = postgresql_statements
+    elif vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 34):
+        # trigram tokenization is only available since SQLite 3.34, older versions fall back to LIKE
+        statements = sqlite_statements
+    else:
+        statements = []
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_indexes(apps, schema_editor):
+    run_statements(schema_editor, POSTGRESQL_FORWARDS, SQLITE_FORWARDS)
+
+
+def drop_search_indexes(apps, schema_editor):
+    run_statements(schema_editor, POSTGRESQL_BACKWARDS, SQLITE_BACKWARDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_movie_fetched_at')
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes)
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_movie_search')
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['movie', 'created_at'], name='api_comment_movie_created_idx')
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['created_at'], name='api_comment_created_at_idx')
+        ),
+        # covered by the (movie, created_at) index
+        migrations.AlterField(
+            model_name='comment',
+            name='movie',
+            field=models.ForeignKey(db_index=False, on_delete=models.deletion.CASCADE, to='api.Movie')
+        ),
+        # covered by the unique (movie, day) index
+        migrations.AlterField(
+            model_name='commentdailycount',
+            name='movie',
+            field=models.ForeignKey(
+                db_index=False, on_delete=models.deletion.CASCADE, related_name='daily_comment_counts', to='api.Movie'
+            )
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['popularity'], name='api_movie_popularity_idx')
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['release_date'], name='api_movie_release_date_idx')
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['vote_average'], name='api_movie_vote_average_idx')
+        )
+    ]
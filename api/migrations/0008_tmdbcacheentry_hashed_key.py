@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+def clear_tmdb_cache(apps, schema_editor):
+    # the entries are keyed on raw lookup keys, and only a cache, so they are dropped rather than rehashed
+    apps.get_model('api', 'TMDbCacheEntry').objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_query_indexes')
+    ]
+
+    operations = [
+        migrations.RunPython(clear_tmdb_cache, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tmdbcacheentry',
+            name='key',
+            field=models.CharField(max_length=32, primary_key=True, serialize=False)
+        ),
+        migrations.AddField(
+            model_name='tmdbcacheentry',
+            name='query',
+            field=models.TextField(default=''),
+            preserve_default=False
+        )
+    ]
@@ -1,9 +1,43 @@
-from typing import List, Dict, Union
-from django.db import models
-from api import tmdb
+import asyncio
+import collections
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Dict, Optional, Tuple, Union
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connections, models, transaction
+from django.db.models.functions import Coalesce, DenseRank, TruncDate
+from django.db.utils import IntegrityError
+from django.utils import timezone
+from api import caching, genres, tmdb
+
+
+class InvalidMovieError(Exception):
+    """TMDb returned a movie which can't be stored."""
+
+
+class GenreManager(models.Manager):
+    def sync_from_tmdb(self) -> Tuple[int, int]:
+        """Add genres new to TMDb and rename changed ones, returning the number of genres added and renamed."""
+        raw_genres = tmdb.fetch_genres()
+        names = dict(self.values_list('id', 'name'))
+        new_genres = [Genre(id=genre['id'], name=genre['name']) for genre in raw_genres if genre['id'] not in names]
+        renamed_genres = [
+            Genre(id=genre['id'], name=genre['name'])
+            for genre in raw_genres if genre['id'] in names and names[genre['id']] != genre['name']
+        ]
+        if new_genres or renamed_genres:
+            with transaction.atomic(using=self.db):
+                self.bulk_create(new_genres, ignore_conflicts=True)
+                self.bulk_update(renamed_genres, ['name'])
+                # bulk operations send no signals
+                genres.invalidate_registry(using=self.db)
+                caching.invalidate_movies()
+        return len(new_genres), len(renamed_genres)
 
 
 class Genre(models.Model):
+    objects = GenreManager()
+
     id = models.PositiveIntegerField(primary_key=True)
     name = models.CharField(max_length=1000)
 
@@ -19,57 +53,237 @@ class Genre(models.Model):
 
 class MovieQuerySet(models.QuerySet):
     def top(self, start_date: str, end_date: str, max_rank: int = None) -> List[Dict[str, Union[str, int]]]:
-        top_movies = [{
-            'movie_id': movie.id,
-            'total_comments': movie.comment_set.filter(
-                created_at__range=(f'{start_date}T00:00:00.000Z', f'{end_date}T23:59:59.999Z')
-            ).count()
-        } for movie in self]
-
-        if top_movies:
-            top_movies.sort(key=lambda movie: movie['total_comments'], reverse=True)
-            current_min_total_comments = top_movies[0]['total_comments']
-            current_rank = 1
-            cutoff_index = len(top_movies)
-            for current_index, movie in enumerate(top_movies):
-                if movie['total_comments'] < current_min_total_comments:
-                    current_rank += 1
-                    current_min_total_comments = movie['total_comments']
-                movie['rank'] = current_rank
-                if max_rank and current_rank > max_rank:
-                    cutoff_index = current_index
-                    break
-
-        return top_movies[:cutoff_index]
+        if max_rank is not None and max_rank < 0:
+            return []
+        # sum the daily comment count rollup instead of counting raw comments, joining only the rows of the period
+        # so that the (movie, day) index skips the other days
+        top_movies = self.annotate(
+            period_comment_counts=models.FilteredRelation('daily_comment_counts', condition=models.Q(
+                daily_comment_counts__day__range=(start_date, end_date)
+            ))
+        ).values('id').annotate(
+            total_comments=Coalesce(models.Sum('period_comment_counts__count'), 0)
+        ).order_by('-total_comments', 'id')
+
+        if connections[self.db].features.supports_over_clause:
+            top_movies = top_movies.annotate(
+                rank=models.Window(DenseRank(), order_by=models.F('total_comments').desc())
+            )
+            if max_rank:
+                # filtering on the window wraps the aggregation in a subquery, so that it is still computed once
+                top_movies = top_movies.filter(rank__lte=max_rank)
+            return [
+                {'movie_id': movie_id, 'total_comments': total_comments, 'rank': rank}
+                for movie_id, total_comments, rank in top_movies.values_list('id', 'total_comments', 'rank')
+            ]
+
+        # fall back to ranking in Python for databases without window function support (e.g. SQLite < 3.25)
+        ranked_top_movies = []
+        current_rank = 0
+        current_min_total_comments = None
+        for movie_id, total_comments in top_movies.values_list('id', 'total_comments'):
+            if total_comments != current_min_total_comments:
+                current_rank += 1
+                current_min_total_comments = total_comments
+            if max_rank and current_rank > max_rank:
+                break
+            ranked_top_movies.append({'movie_id': movie_id, 'total_comments': total_comments, 'rank': current_rank})
+        return ranked_top_movies
 
 
 class MovieManager(models.Manager):
     def get_queryset(self):
         return MovieQuerySet(self.model, using=self._db)
 
+    @staticmethod
+    def get_tmdb_values(raw_movie: dict) -> dict:
+        """Map a TMDb movie to the values of its fields, raising InvalidMovieError if it can't be stored."""
+        # TMDb leaves the release date of unreleased movies empty, but it is required here
+        if not raw_movie.get('release_date'):
+            raise InvalidMovieError(f'TMDb movie {raw_movie.get("id")} has no release date')
+        return {field: raw_movie[field] for field in Movie.TMDB_FIELDS}
+
+    def upsert_from_tmdb(self, raw_movie: dict) -> Tuple['Movie', bool, bool]:
+        """Create or update a movie from its TMDb representation in a fixed number of queries.
+
+        Returns the movie, whether it was created and whether anything about it changed. Unchanged movies are
+        not written to at all. Raises InvalidMovieError if the movie can't be stored.
+        """
+        values = self.get_tmdb_values(raw_movie)
+        values['fetched_at'] = timezone.now()
+        genre_ids = genres.get_registry().get_known_ids(raw_movie['genre_ids'])
+        MovieGenre = self.model.genres.through
+        with transaction.atomic(using=self.db):
+            movie, created = self.get_or_create(id=values.pop('id'), defaults=values)
+            if created:
+                existing_genre_ids = set()
+                changed = True
+            else:
+                existing_genre_ids = set(
+                    MovieGenre.objects.using(self.db).filter(movie_id=movie.id).values_list('genre_id', flat=True)
+                )
+                fetched_at = values.pop('fetched_at')
+                changed_fields = []
+                for field, value in values.items():
+                    value = movie._meta.get_field(field).to_python(value)
+                    if getattr(movie, field) != value:
+                        setattr(movie, field, value)
+                        changed_fields.append(field)
+                if changed_fields:
+                    movie.fetched_at = fetched_at
+                    movie.save(update_fields=changed_fields + ['fetched_at'])
+                changed = bool(changed_fields)
+            # genres are only ever added, like with the stats they come from TMDb
+            if genre_ids - existing_genre_ids:
+                MovieGenre.objects.using(self.db).bulk_create([
+                    MovieGenre(movie_id=movie.id, genre_id=genre_id) for genre_id in genre_ids - existing_genre_ids
+                ], ignore_conflicts=True)
+                changed = True
+            if changed:
+                caching.invalidate_movies()
+        movie.genre_ids = sorted(existing_genre_ids | genre_ids)
+        return movie, created, changed
+
     def update_or_create_from_tmdb(self, title: str) -> tuple:
         raw_movie = tmdb.fetch_movie(title)
         if not raw_movie:
             raise ValueError('no matching movie was found')
-        movie, created = self.update_or_create(
-            id=raw_movie['id'],
-            overview=raw_movie['overview'],
-            release_date=raw_movie['release_date'],
-            original_title=raw_movie['original_title'],
-            original_language=raw_movie['original_language'],
-            title=raw_movie['title'],
-            popularity=raw_movie['popularity'],
-            vote_count=raw_movie['vote_count'],
-            vote_average=raw_movie['vote_average'],
+        movie, created, _ = self.upsert_from_tmdb(raw_movie)
+        return movie, created
+
+    async def aupdate_or_create_from_tmdb(self, title: str) -> tuple:
+        """Like update_or_create_from_tmdb, but without blocking the event loop on TMDb."""
+        raw_movie = await tmdb.afetch_movie(title)
+        if not raw_movie:
+            raise ValueError('no matching movie was found')
+        movie, created, _ = await sync_to_async(self.upsert_from_tmdb)(raw_movie)
+        return movie, created
+
+    def bulk_update_or_create_from_tmdb(
+            self, titles: Iterable[str], max_workers: int = 8, batch_size: int = 500
+    ) -> List[Dict[str, Optional[Union[str, int]]]]:
+        """Fetch many titles from TMDb concurrently and upsert the matching movies in batches.
+
+        Returns a report with the status of each title: created, updated, not_found, invalid (TMDb returned
+        a movie that cannot be stored) or unavailable (TMDb could not be reached).
+        """
+        titles = list(dict.fromkeys(title.strip() for title in titles if title.strip()))
+
+        def fetch_movie(title: str) -> Tuple[str, Optional[dict]]:
+            try:
+                return 'found', tmdb.fetch_movie(title)
+            except tmdb.TMDbError:
+                return 'unavailable', None
+            finally:
+                # cache backends may have used a connection in this worker thread
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetch_results = list(executor.map(fetch_movie, titles))
+        return self.bulk_upsert_from_tmdb(titles, fetch_results, batch_size)
+
+    async def abulk_update_or_create_from_tmdb(
+            self, titles: Iterable[str], batch_size: int = 500
+    ) -> List[Dict[str, Optional[Union[str, int]]]]:
+        """Like bulk_update_or_create_from_tmdb, but with all TMDb lookups in flight at once on the event loop.
+
+        Concurrency is bounded by the async TMDb client's connection pool and rate limit rather than by threads.
+        """
+        titles = list(dict.fromkeys(title.strip() for title in titles if title.strip()))
+
+        async def fetch_movie(title: str) -> Tuple[str, Optional[dict]]:
+            try:
+                return 'found', await tmdb.afetch_movie(title)
+            except tmdb.TMDbError:
+                return 'unavailable', None
+
+        fetch_results = await asyncio.gather(*(fetch_movie(title) for title in titles))
+        return await sync_to_async(self.bulk_upsert_from_tmdb)(titles, fetch_results, batch_size)
+
+    def bulk_upsert_from_tmdb(
+            self, titles: List[str], fetch_results: List[Tuple[str, Optional[dict]]], batch_size: int = 500
+    ) -> List[Dict[str, Optional[Union[str, int]]]]:
+        """Upsert the movies fetched for titles in batches, returning the report of bulk_update_or_create_from_tmdb.
+
+        fetch_results holds a (status, raw movie) pair per title, status being found or unavailable.
+        """
+        raw_movies = {}
+        movie_values = {}
+        report = []
+        for title, (status, raw_movie) in zip(titles, fetch_results):
+            if status == 'found' and not raw_movie:
+                status = 'not_found'
+            elif status == 'found':
+                try:
+                    movie_values[raw_movie['id']] = self.get_tmdb_values(raw_movie)
+                    raw_movies[raw_movie['id']] = raw_movie
+                except InvalidMovieError:
+                    status = 'invalid'
+            report.append({'title': title, 'status': status, 'movie_id': raw_movie['id'] if raw_movie else None})
+
+        existing_movie_ids = set(self.filter(id__in=raw_movies).values_list('id', flat=True))
+        known_genre_ids = genres.get_registry().get_known_ids(
+            genre_id for raw_movie in raw_movies.values() for genre_id in raw_movie['genre_ids']
         )
-        for genre_id in raw_movie['genre_ids']:
+        MovieGenre = self.model.genres.through
+        fetched_at = timezone.now()
+        with transaction.atomic(using=self.db):
+            self.bulk_create(
+                [
+                    self.model(fetched_at=fetched_at, **values) for values in movie_values.values()
+                ],
+                batch_size=batch_size, update_conflicts=True, unique_fields=['id'],
+                update_fields=[field for field in Movie.TMDB_FIELDS if field != 'id'] + ['fetched_at']
+            )
+            MovieGenre.objects.using(self.db).bulk_create([
+                MovieGenre(movie_id=movie_id, genre_id=genre_id)
+                for movie_id, raw_movie in raw_movies.items()
+                for genre_id in raw_movie['genre_ids'] if genre_id in known_genre_ids
+            ], batch_size=batch_size, ignore_conflicts=True)
+            caching.invalidate_movies()
+
+        for title_report in report:
+            if title_report['status'] == 'found':
+                title_report['status'] = 'updated' if title_report['movie_id'] in existing_movie_ids else 'created'
+        return report
+
+    def stale(self, max_age: dt.timedelta) -> MovieQuerySet:
+        """Movies whose TMDb stats were last fetched longer than max_age ago (or never), stalest first."""
+        return self.filter(
+            models.Q(fetched_at__isnull=True) | models.Q(fetched_at__lt=timezone.now() - max_age)
+        ).order_by(models.F('fetched_at').asc(nulls_first=True), 'id')
+
+    def refresh_from_tmdb(
+            self, movies: Iterable['Movie'], before_fetch: Callable[[], bool] = lambda: True
+    ) -> Tuple[int, int]:
+        """Refresh the TMDb stats of the given movies, writing them back in a single bulk update.
+
+        before_fetch is called before every TMDb request and may block to stay within a request budget, or return
+        False to stop early. Returns the number of movies refreshed and the number of them which changed.
+        """
+        refreshed_movies = []
+        changed_count = 0
+        for movie in movies:
+            if not before_fetch():
+                break
             try:
-                genre = Genre.objects.get(id=genre_id)
-            except Genre.DoesNotExist:
-                pass
-            else:
-                movie.genres.add(genre)
-        return movie, created
+                raw_movie = tmdb.fetch_movie_details(movie.id)
+            except tmdb.TMDbNotFoundError:
+                # keep the movie, but don't retry it before the others
+                raw_movie = {}
+            except tmdb.TMDbError:
+                continue
+            stats = {field: raw_movie.get(field, getattr(movie, field)) for field in Movie.TMDB_STATS_FIELDS}
+            if any(getattr(movie, field) != value for field, value in stats.items()):
+                changed_count += 1
+                for field, value in stats.items():
+                    setattr(movie, field, value)
+            movie.fetched_at = timezone.now()
+            refreshed_movies.append(movie)
+        self.bulk_update(refreshed_movies, Movie.TMDB_STATS_FIELDS + ['fetched_at'])
+        if changed_count:
+            caching.invalidate_movies()
+        return len(refreshed_movies), changed_count
 
 
 class Movie(models.Model):
@@ -79,8 +293,18 @@ class Movie(models.Model):
 
     SORTABLE_FIELDS = __SORTABLE_FIELDS + [f'-{field}' for field in __SORTABLE_FIELDS]
 
+    TMDB_FIELDS = [
+        'id', 'overview', 'release_date', 'original_title', 'original_language', 'title', 'popularity', 'vote_count',
+        'vote_average'
+    ]
+
+    TMDB_STATS_FIELDS = ['popularity', 'vote_count', 'vote_average']
+
     objects = MovieManager()
 
+    # IDs of the movie's genres when known without a query, as after upsert_from_tmdb
+    genre_ids: Optional[List[int]] = None
+
     id = models.PositiveIntegerField(primary_key=True)
     overview = models.TextField()
     release_date = models.DateField()
@@ -91,16 +315,36 @@ class Movie(models.Model):
     popularity = models.FloatField()
     vote_count = models.PositiveIntegerField()
     vote_average = models.FloatField()
+    fetched_at = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # the most common orderings of GET /movies
+            models.Index(fields=['popularity'], name='api_movie_popularity_idx'),
+            models.Index(fields=['release_date'], name='api_movie_release_date_idx'),
+            models.Index(fields=['vote_average'], name='api_movie_vote_average_idx')
+        ]
 
     def __str__(self):
         return self.title
 
+    def get_genre_dicts(self) -> List[dict]:
+        if 'genres' in getattr(self, '_prefetched_objects_cache', {}):
+            return [genre.to_dict() for genre in self.genres.all()]
+        genre_ids = self.genre_ids
+        if genre_ids is None:
+            # names come from the genre registry, so only the IDs need to be queried
+            genre_ids = self.genres.through.objects.using(self._state.db).filter(movie_id=self.id).order_by(
+                'genre_id'
+            ).values_list('genre_id', flat=True)
+        return genres.get_registry().get_dicts(genre_ids)
+
     def to_dict(self) -> dict:
         return {
             'id': self.id,
             'overview': self.overview,
             'release_date': self.release_date,
-            'genres': [genre.to_dict() for genre in self.genres.all()],
+            'genres': self.get_genre_dicts(),
             'original_title': self.original_title,
             'original_language': self.original_language,
             'title': self.title,
@@ -110,18 +354,126 @@ class Movie(models.Model):
         }
 
 
+class CommentManager(models.Manager):
+    def ingest(self, comments: List['Comment']) -> List['Comment']:
+        """Create many comments in a single transaction, updating the rollup and the response cache like save does."""
+        with transaction.atomic(using=self.db):
+            comments = self.bulk_create(comments)
+            daily_counts = collections.Counter(
+                (comment.movie_id, comment.created_at.astimezone(dt.timezone.utc).date()) for comment in comments
+            )
+            for (movie_id, day), count in sorted(daily_counts.items()):
+                CommentDailyCount.objects.db_manager(self.db).increment(movie_id, day, count)
+            caching.invalidate_comments(comment.movie_id for comment in comments)
+        return comments
+
+
 class Comment(models.Model):
+    objects = CommentManager()
+
     created_at = models.DateTimeField(auto_now_add=True)
-    movie = models.ForeignKey(Movie, on_delete=models.CASCADE)
+    # indexed as the first column of the (movie, created_at) index
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, db_index=False)
     text = models.TextField()
 
+    class Meta:
+        indexes = [
+            # GET /comments?movie_id=…, in creation order
+            models.Index(fields=['movie', 'created_at'], name='api_comment_movie_created_idx'),
+            # GET /comments, in creation order, and rebuilding daily comment counts for a date range
+            models.Index(fields=['created_at'], name='api_comment_created_at_idx')
+        ]
+
     def __str__(self):
         return self.text
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            CommentDailyCount.objects.db_manager(self._state.db).increment(
+                self.movie_id, self.created_at.astimezone(dt.timezone.utc).date()
+            )
+            caching.invalidate_comments([self.movie_id])
+
     def to_dict(self) -> dict:
         return {
             'id': self.id,
             'created_at': self.created_at,
-            'movie_id': self.movie.id,
+            'movie_id': self.movie_id,
             'text': self.text,
         }
+
+
+class CommentDailyCountManager(models.Manager):
+    def increment(self, movie_id: int, day: dt.date, count: int = 1):
+        """Atomically add count to the rollup row of the given movie and day, creating the row if needed."""
+        with transaction.atomic(using=self.db):
+            if self.filter(movie_id=movie_id, day=day).update(count=models.F('count') + count):
+                return
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(movie_id=movie_id, day=day, count=count)
+            except IntegrityError:
+                # another transaction created the row in the meantime
+                self.filter(movie_id=movie_id, day=day).update(count=models.F('count') + count)
+
+    def count_comments(self) -> Dict[Tuple[int, dt.date], int]:
+        """Count comments per movie and day straight from the Comment table."""
+        return {
+            (row['movie_id'], row['day']): row['count']
+            for row in Comment.objects.using(self.db).annotate(
+                day=TruncDate('created_at', tzinfo=dt.timezone.utc)
+            ).values('movie_id', 'day').annotate(count=models.Count('id')).order_by()
+        }
+
+    def rebuild(self) -> int:
+        """Rebuild the whole rollup from the Comment table, returning the number of rollup rows."""
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            daily_counts = self.bulk_create([
+                self.model(movie_id=movie_id, day=day, count=count)
+                for (movie_id, day), count in self.count_comments().items()
+            ], batch_size=1000)
+            caching.invalidate_all()
+        return len(daily_counts)
+
+    def find_inconsistencies(self) -> List[Tuple[int, dt.date, int, int]]:
+        """List (movie_id, day, expected count, rollup count) for every rollup row that disagrees with Comment."""
+        expected_counts = self.count_comments()
+        actual_counts = {
+            (movie_id, day): count for movie_id, day, count in self.values_list('movie_id', 'day', 'count')
+        }
+        return [
+            (movie_id, day, expected_counts.get((movie_id, day), 0), actual_counts.get((movie_id, day), 0))
+            for movie_id, day in sorted(expected_counts.keys() | actual_counts.keys())
+            if expected_counts.get((movie_id, day), 0) != actual_counts.get((movie_id, day), 0)
+        ]
+
+
+class CommentDailyCount(models.Model):
+    objects = CommentDailyCountManager()
+
+    # indexed as the first column of the unique (movie, day) index
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='daily_comment_counts', db_index=False)
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('movie', 'day')
+
+    def __str__(self):
+        return f'{self.movie_id} @ {self.day}: {self.count}'
+
+
+class TMDbCacheEntry(models.Model):
+    # MD5 digest of the lookup's key, which may be arbitrarily long
+    key = models.CharField(max_length=32, primary_key=True)
+    # the key itself, for debugging
+    query = models.TextField()
+    value = models.JSONField(null=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.query
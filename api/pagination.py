@@ -0,0 +1,100 @@
+import base64
+import binascii
+import datetime as dt
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+from django.core.exceptions import ValidationError
+from django.db import models
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def normalize_order_by(order_by: Sequence[str]) -> List[str]:
+    """Make ordering total by appending the ID as a tiebreaker, dropping repeated and redundant fields."""
+    normalized_order_by = []
+    field_names = set()
+    for field in order_by:
+        field_name = field.lstrip('-')
+        if field_name in field_names:
+            continue
+        normalized_order_by.append(field)
+        field_names.add(field_name)
+        if field_name == 'id':
+            # IDs are unique, so any fields after them never matter
+            return normalized_order_by
+    return normalized_order_by + ['id']
+
+
+def encode_cursor(order_by: Sequence[str], values: Sequence[Any]) -> str:
+    """Encode the position after a row as an opaque cursor."""
+    raw_cursor = json.dumps({
+        'order_by': list(order_by),
+        'values': [value.isoformat() if isinstance(value, (dt.date, dt.datetime)) else value for value in values]
+    }, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw_cursor.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, order_by: Sequence[str]) -> List[Any]:
+    """Decode the row position values from a cursor, making sure it was created for the same ordering."""
+    try:
+        raw_cursor = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_order_by, values = raw_cursor['order_by'], raw_cursor['values']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursorError('malformed cursor')
+    if cursor_order_by != list(order_by) or not isinstance(values, list) or len(values) != len(order_by):
+        raise InvalidCursorError('cursor does not match ordering')
+    return values
+
+
+def filter_after(queryset: models.QuerySet, order_by: Sequence[str], values: Sequence[Any]) -> models.QuerySet:
+    """Filter the queryset to rows strictly after the given position in the given ordering."""
+    after = models.Q()
+    for index, field in enumerate(order_by):
+        field_name = field.lstrip('-')
+        condition = models.Q(**{f'{field_name}__{"lt" if field.startswith("-") else "gt"}': values[index]})
+        for previous_field, previous_value in zip(order_by[:index], values[:index]):
+            condition &= models.Q(**{previous_field.lstrip('-'): previous_value})
+        after |= condition
+    return queryset.filter(after)
+
+
+def paginate(
+        queryset: models.QuerySet, order_by: Sequence[str], limit: int, cursor: Optional[str] = None,
+        fields: Optional[Sequence[str]] = None
+) -> Tuple[list, Optional[str]]:
+    """Fetch one page of the queryset using keyset pagination, returning its rows and the cursor of the next page.
+
+    Rows are model instances, or tuples of the given fields if any. Ordering fields which aren't among them, such as
+    annotations, are fetched too for the cursor, but left out of the rows.
+    Unlike OFFSET, every page costs the same to fetch, since the database seeks straight to the cursor position.
+    """
+    order_by = normalize_order_by(order_by)
+    queryset = queryset.order_by(*order_by)
+    if cursor:
+        values = decode_cursor(cursor, order_by)
+        try:
+            queryset = filter_after(queryset, order_by, values)
+        except (ValidationError, ValueError, TypeError) as e:
+            # values which do not fit the fields they are compared against
+            raise InvalidCursorError('malformed cursor') from e
+    if fields is not None:
+        fetched_fields = list(fields) + [field.lstrip('-') for field in order_by if field.lstrip('-') not in fields]
+        queryset = queryset.values_list(*fetched_fields)
+    # fetch one extra row to find out whether there is a next page
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if fields is not None:
+            values = [rows[-1][fetched_fields.index(field.lstrip('-'))] for field in order_by]
+        else:
+            values = [getattr(rows[-1], field.lstrip('-')) for field in order_by]
+        next_cursor = encode_cursor(order_by, values)
+    if fields is not None and len(fetched_fields) > len(fields):
+        rows = [row[:len(fields)] for row in rows]
+    return rows, next_cursor
@@ -0,0 +1,199 @@
+import contextvars
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import OperationalError
+from django.core.exceptions import SynchronousOnlyOperation
+
+SELECTION_STRATEGIES = ('round_robin', 'least_latency')
+# methods which never write, so that they can be served from replicas
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# cookie marking clients which wrote recently, holding the time until which they read from the primary
+STICKY_COOKIE = 'primary_until'
+# weight of the latest query in the moving average latency of a replica
+LATENCY_SMOOTHING = 0.2
+
+# set for the duration of requests served from a replica, and inherited by the threads sync_to_async runs in
+_read_alias: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('read_alias', default=None)
+
+
+class ReplicaSelector:
+    """Picks the replica to read from, round robin or by least (moving average) latency, skipping unhealthy ones.
+
+    A replica which fails to connect or to run a query is skipped for retry_interval seconds.
+    """
+
+    def __init__(
+            self, aliases: List[str], strategy: str = 'round_robin', retry_interval: float = 30,
+            clock=time.monotonic
+    ):
+        if strategy not in SELECTION_STRATEGIES:
+            raise ValueError(f'unknown replica selection strategy {strategy!r}')
+        self.aliases = list(aliases)
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.latencies: Dict[str, float] = {alias: 0.0 for alias in self.aliases}
+        self.down_until: Dict[str, float] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def is_up(self, alias: str) -> bool:
+        down_until = self.down_until.get(alias)
+        return down_until is None or down_until <= self.clock()
+
+    def mark_down(self, alias: str):
+        self.down_until[alias] = self.clock() + self.retry_interval
+
+    def observe(self, alias: str, duration: float):
+        with self._lock:
+            self.latencies[alias] += LATENCY_SMOOTHING * (duration - self.latencies[alias])
+
+    def select(self) -> str:
+        """Get the replica to read from, or the primary if no replica is up."""
+        aliases = [alias for alias in self.aliases if self.is_up(alias)]
+        if not aliases:
+            return DEFAULT_DB_ALIAS
+        if self.strategy == 'least_latency':
+            return min(aliases, key=self.latencies.__getitem__)
+        return aliases[next(self._counter) % len(aliases)]
+
+    def check(self, alias: str) -> bool:
+        """Make sure a connection to the replica can be opened in this thread, marking it down if not."""
+        if not self.is_up(alias):
+            return False
+        try:
+            connections[alias].ensure_connection()
+        except OperationalError:
+            self.mark_down(alias)
+            return False
+        except SynchronousOnlyOperation:
+            # called from async code, where queries aren't made anyway
+            pass
+        return True
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def get_selector() -> Optional[ReplicaSelector]:
+    """Get the replica selector configured in the DATABASE_REPLICAS setting, or None if there are no replicas."""
+    global _selector
+    if _selector is None and settings.DATABASE_REPLICAS:
+        with _selector_lock:
+            if _selector is None:
+                _selector = ReplicaSelector(
+                    settings.DATABASE_REPLICAS, settings.REPLICA_SELECTION, settings.REPLICA_RETRY_INTERVAL
+                )
+    return _selector
+
+
+def reset_selector():
+    """Drop the replica selector, so that it gets rebuilt from settings on next use."""
+    global _selector
+    with _selector_lock:
+        _selector = None
+
+
+def record_replica_query(execute, sql, params, many, context):
+    """Database execute wrapper tracking the latency of replica queries and marking failing replicas down."""
+    alias = context['connection'].alias
+    selector = _selector
+    if selector is None or alias not in selector.latencies:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        result = execute(sql, params, many, context)
+    except OperationalError:
+        selector.mark_down(alias)
+        raise
+    selector.observe(alias, time.perf_counter() - start)
+    return result
+
+
+def install_replica_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver installing record_replica_query on every new database connection."""
+    connection.execute_wrappers.append(record_replica_query)
+
+
+def reads_from_replica() -> bool:
+    """Determine whether the current request was picked to read from a replica, which may lag behind the primary."""
+    return _read_alias.get() not in (None, DEFAULT_DB_ALIAS)
+
+
+class ReplicaRouter:
+    """Routes reads of requests picked by ReplicaRoutingMiddleware to a replica, and everything else to the primary."""
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        alias = _read_alias.get()
+        if alias is None or alias == DEFAULT_DB_ALIAS:
+            return None
+        selector = get_selector()
+        if selector is None:
+            return DEFAULT_DB_ALIAS
+        while alias != DEFAULT_DB_ALIAS and not selector.check(alias):
+            # fail over to another replica, or to the primary once none is up
+            alias = selector.select()
+        return alias
+
+    def db_for_write(self, model, **hints) -> Optional[str]:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # replicas hold the same data as the primary
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    """Picks a replica for reading requests, while writing requests go to the primary.
+
+    Clients which wrote within the last READ_YOUR_WRITES_WINDOW seconds read from the primary too, so that they see
+    their own writes despite replication lag. Content streamed after the view returns is read from the primary.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def get_read_alias(self, request) -> Optional[str]:
+        selector = get_selector()
+        if selector is None or request.method not in READ_METHODS:
+            return None
+        try:
+            if float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time():
+                return None
+        except ValueError:
+            pass
+        return selector.select()
+
+    def mark_write(self, request, response):
+        window = settings.READ_YOUR_WRITES_WINDOW
+        if settings.DATABASE_REPLICAS and window and request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _read_alias.set(self.get_read_alias(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        return self.mark_write(request, response)
+
+    async def __acall__(self, request):
+        token = _read_alias.set(self.get_read_alias(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        return self.mark_write(request, response)
@@ -0,0 +1,105 @@
+from typing import Dict, List
+from django.db import connections, models
+from django.db.models.functions import Cast, Greatest, Upper
+
+SEARCH_MODES = ('substring', 'prefix', 'fuzzy', 'exact')
+SEARCH_TABLE = 'api_movie_search'
+# SQLite trigram full-text search can't match anything shorter than a single trigram
+MIN_FTS_QUERY_LENGTH = 3
+
+_search_table_available: Dict[str, bool] = {}
+
+
+class TrigramSimilar(models.Func):
+    """Postgres pg_trgm `%` operator, which can use trigram indexes."""
+    arg_joiner = ' %% '
+    template = '(%(expressions)s)'
+    output_field = models.BooleanField()
+
+
+class TrigramSimilarity(models.Func):
+    """Postgres pg_trgm similarity (0–1)."""
+    function = 'SIMILARITY'
+    output_field = models.FloatField()
+
+
+def normalize_title(field: str) -> models.Func:
+    # the same expression as in the trigram indexes and in Django's case-insensitive lookups on Postgres
+    return Upper(Cast(field, models.TextField()))
+
+
+def quote_fts_string(string: str) -> str:
+    return '"' + string.replace('"', '""') + '"'
+
+
+def get_trigrams(string: str) -> List[str]:
+    return list(dict.fromkeys(string[index:index + 3] for index in range(len(string) - 2)))
+
+
+def is_search_table_available(alias: str) -> bool:
+    """Check whether the SQLite full-text search table exists (it needs SQLite 3.34+ with FTS5)."""
+    if alias not in _search_table_available:
+        _search_table_available[alias] = SEARCH_TABLE in connections[alias].introspection.table_names()
+    return _search_table_available[alias]
+
+
+def search_movies(movies: models.QuerySet, query: str, mode: str = 'substring') -> models.QuerySet:
+    """Filter movies to those whose title or original title matches the query, most relevant first.
+
+    Modes:
+    - substring: the query appears anywhere in the title
+    - prefix: the title starts with the query
+    - fuzzy: the title is similar to the query, tolerating typos
+    - exact: the title is the query, ignoring case
+
+    On Postgres, matching is backed by pg_trgm GIN indexes. On SQLite, it is backed by a trigram FTS5 table.
+    """
+    query = ' '.join(query.split())
+    vendor = connections[movies.db].vendor
+    if mode == 'exact':
+        return movies.filter(
+            models.Q(title__iexact=query) | models.Q(original_title__iexact=query)
+        ).order_by('-popularity', 'id')
+    if vendor == 'postgresql':
+        return search_movies_postgresql(movies, query, mode)
+    if vendor == 'sqlite' and len(query) >= MIN_FTS_QUERY_LENGTH and is_search_table_available(movies.db):
+        return search_movies_sqlite(movies, query, mode)
+    if mode == 'prefix':
+        matches = models.Q(title__istartswith=query) | models.Q(original_title__istartswith=query)
+    else:
+        matches = models.Q(title__icontains=query) | models.Q(original_title__icontains=query)
+    return movies.filter(matches).order_by('-popularity', 'id')
+
+
+def search_movies_postgresql(movies: models.QuerySet, query: str, mode: str) -> models.QuerySet:
+    if mode == 'fuzzy':
+        matches = (
+            models.Q(TrigramSimilar(normalize_title('title'), Upper(models.Value(query)))) |
+            models.Q(TrigramSimilar(normalize_title('original_title'), Upper(models.Value(query))))
+        )
+    elif mode == 'prefix':
+        matches = models.Q(title__istartswith=query) | models.Q(original_title__istartswith=query)
+    else:
+        matches = models.Q(title__icontains=query) | models.Q(original_title__icontains=query)
+    return movies.filter(matches).annotate(relevance=Greatest(
+        TrigramSimilarity(normalize_title('title'), Upper(models.Value(query))),
+        TrigramSimilarity(normalize_title('original_title'), Upper(models.Value(query)))
+    )).order_by('-relevance', '-popularity', 'id')
+
+
+def search_movies_sqlite(movies: models.QuerySet, query: str, mode: str) -> models.QuerySet:
+    if mode == 'fuzzy':
+        # any shared trigram matches, and BM25 ranks titles sharing more (and rarer) trigrams higher
+        fts_query = ' OR '.join(quote_fts_string(trigram) for trigram in get_trigrams(query))
+    else:
+        fts_query = quote_fts_string(query)
+    movies = movies.filter(id__in=models.expressions.RawSQL(
+        f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', (fts_query,)
+    ))
+    if mode == 'prefix':
+        movies = movies.filter(models.Q(title__istartswith=query) | models.Q(original_title__istartswith=query))
+    return movies.annotate(relevance=models.expressions.RawSQL(
+        f'SELECT -bm25({SEARCH_TABLE}) FROM {SEARCH_TABLE} '
+        f'WHERE {SEARCH_TABLE} MATCH %s AND {SEARCH_TABLE}.rowid = "api_movie"."id"',
+        (fts_query,), output_field=models.FloatField()
+    )).order_by('-relevance', '-popularity', 'id')
@@ -0,0 +1,152 @@
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models
+from api import genres, instrumentation
+from api.models import Movie, Comment
+
+# fields fetched for serialization, in the order of the to_dict keys (genres come after release_date)
+MOVIE_FIELDS = [
+    'id', 'overview', 'release_date', 'original_title', 'original_language', 'title', 'popularity', 'vote_count',
+    'vote_average'
+]
+COMMENT_FIELDS = ['id', 'created_at', 'movie_id', 'text']
+
+_encoder = DjangoJSONEncoder()
+
+
+class StdlibJSONBackend:
+    """The json module, producing exactly the same output as JsonResponse."""
+    name = 'stdlib'
+    item_separator = b', '
+
+    @staticmethod
+    def dumps(data: Any) -> bytes:
+        return json.dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+class OrjsonJSONBackend:
+    """orjson, several times faster than the json module, with compact output and non-ASCII characters unescaped."""
+    name = 'orjson'
+    item_separator = b','
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, data: Any) -> bytes:
+        return self.orjson.dumps(data, default=_encoder.default)
+
+
+_json_backend = None
+
+
+def get_json_backend():
+    """Get the JSON backend configured in the JSON_BACKEND setting: stdlib, orjson or auto (orjson if installed)."""
+    global _json_backend
+    if _json_backend is None:
+        if settings.JSON_BACKEND == 'stdlib':
+            _json_backend = StdlibJSONBackend()
+        elif settings.JSON_BACKEND == 'orjson':
+            _json_backend = OrjsonJSONBackend()
+        elif settings.JSON_BACKEND == 'auto':
+            try:
+                _json_backend = OrjsonJSONBackend()
+            except ImportError:
+                _json_backend = StdlibJSONBackend()
+        else:
+            raise ValueError(f'unknown JSON backend {settings.JSON_BACKEND!r}')
+    return _json_backend
+
+
+def reset_json_backend():
+    """Drop the configured JSON backend, so that it gets picked from settings on next use."""
+    global _json_backend
+    _json_backend = None
+
+
+def encode_json(data: Any) -> bytes:
+    start = time.perf_counter()
+    content = get_json_backend().dumps(data)
+    instrumentation.record('json', time.perf_counter() - start)
+    return content
+
+
+def get_genres(movie_ids: Sequence[int], using: str) -> Dict[int, List[Dict[str, Any]]]:
+    """Get the genre dicts of each of the movies, in as few queries as the database's parameter limit allows.
+
+    Only the genre IDs are queried, with the dicts coming from the genre registry.
+    """
+    MovieGenre = Movie.genres.through
+    genre_ids_by_movie = {}
+    batch_size = connections[using].ops.bulk_batch_size(['movie_id'], movie_ids) or len(movie_ids)
+    for start in range(0, len(movie_ids), batch_size):
+        for movie_id, genre_id in MovieGenre.objects.using(using).filter(
+                movie_id__in=movie_ids[start:start + batch_size]
+        ).order_by('movie_id', 'genre_id').values_list('movie_id', 'genre_id'):
+            genre_ids_by_movie.setdefault(movie_id, []).append(genre_id)
+    registry = genres.get_registry()
+    return {movie_id: registry.get_dicts(genre_ids) for movie_id, genre_ids in genre_ids_by_movie.items()}
+
+
+def serialize_movie_rows(rows: Sequence[tuple], using: str) -> List[Dict[str, Any]]:
+    """Build the to_dict representation of movies from MOVIE_FIELDS rows, with dates already formatted."""
+    genres_by_movie = get_genres([row[0] for row in rows], using) if rows else {}
+    return [
+        {
+            'id': movie_id,
+            'overview': overview,
+            'release_date': release_date.isoformat(),
+            'genres': genres_by_movie.get(movie_id, []),
+            'original_title': original_title,
+            'original_language': original_language,
+            'title': title,
+            'popularity': popularity,
+            'vote_count': vote_count,
+            'vote_average': vote_average
+        }
+        for (
+            movie_id, overview, release_date, original_title, original_language, title, popularity, vote_count,
+            vote_average
+        ) in rows
+    ]
+
+
+def serialize_comment_rows(rows: Sequence[tuple], using: str) -> List[Dict[str, Any]]:
+    """Build the to_dict representation of comments from COMMENT_FIELDS rows, with datetimes already formatted."""
+    return [
+        {'id': comment_id, 'created_at': _encoder.default(created_at), 'movie_id': movie_id, 'text': text}
+        for comment_id, created_at, movie_id, text in rows
+    ]
+
+
+ROW_SERIALIZERS: Dict[type, Tuple[List[str], Callable[[Sequence[tuple], str], List[Dict[str, Any]]]]] = {
+    Movie: (MOVIE_FIELDS, serialize_movie_rows),
+    Comment: (COMMENT_FIELDS, serialize_comment_rows)
+}
+
+
+def get_row_serializer(queryset: models.QuerySet) -> Tuple[List[str], Callable[[Sequence[tuple], str], list]]:
+    """Get the fields to fetch for the queryset's model and the function serializing rows of them."""
+    return ROW_SERIALIZERS[queryset.model]
+
+
+def serialize(queryset: models.QuerySet) -> List[Dict[str, Any]]:
+    """Serialize the objects of the queryset like their to_dict would, without instantiating models."""
+    fields, serialize_rows = get_row_serializer(queryset)
+    return serialize_rows(list(queryset.values_list(*fields)), queryset.db)
+
+
+def serialize_chunks(queryset: models.QuerySet, chunk_size: int) -> Iterable[List[Dict[str, Any]]]:
+    """Serialize the objects of the queryset in chunks, fetching them chunk_size at a time with constant memory."""
+    fields, serialize_rows = get_row_serializer(queryset)
+    rows = []
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield serialize_rows(rows, queryset.db)
+            rows = []
+    if rows:
+        yield serialize_rows(rows, queryset.db)
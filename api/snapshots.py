@@ -0,0 +1,275 @@
+import contextlib
+import datetime as dt
+import gzip
+import io
+import json
+import sys
+from typing import IO, Any, Callable, Dict, Iterator, List
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+from api import caching, genres
+from api.models import Genre, Movie, Comment, CommentDailyCount
+
+FORMAT = 'movieproxy-catalog'
+VERSION = 1
+
+# fields of each record type, by attname, with the IDs of its genres appended to every movie record
+FIELDS = {
+    'genre': ['id', 'name'],
+    'movie': Movie.TMDB_FIELDS + ['fetched_at'],
+    'comment': ['id', 'created_at', 'movie_id', 'text']
+}
+MovieGenre = Movie.genres.through
+MODELS = {'genre': Genre, 'movie': Movie, 'genre_link': MovieGenre, 'comment': Comment}
+
+
+class SnapshotError(Exception):
+    """The snapshot can't be read, or can't be imported into this database."""
+
+
+def encode_value(value: Any) -> str:
+    # isoformat rather than DjangoJSONEncoder, which truncates microseconds
+    if isinstance(value, (dt.date, dt.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def open_snapshot(path: str, mode: str) -> IO[str]:
+    """Open a gzip-compressed snapshot for reading (r) or writing (w) as text, - meaning standard input/output."""
+    if path == '-':
+        stream = sys.stdin.buffer if mode == 'r' else sys.stdout.buffer
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=stream, mode=f'{mode}b'), encoding='utf-8')
+    return gzip.open(path, f'{mode}t', encoding='utf-8', compresslevel=6)
+
+
+def iterate_records(include_comments: bool, chunk_size: int, using: str) -> Iterator[list]:
+    """Yield the records of the catalogue, reading it chunk_size rows at a time with constant memory."""
+    for row in Genre.objects.using(using).order_by('id').values_list(*FIELDS['genre']).iterator(chunk_size):
+        yield ['genre', *row]
+    # movies and their genre links, both by movie ID, merged as they are read
+    links = MovieGenre.objects.using(using).order_by('movie_id', 'genre_id').values_list(
+        'movie_id', 'genre_id'
+    ).iterator(chunk_size)
+    link = next(links, None)
+    for row in Movie.objects.using(using).order_by('id').values_list(*FIELDS['movie']).iterator(chunk_size):
+        genre_ids = []
+        while link is not None and link[0] <= row[0]:
+            if link[0] == row[0]:
+                genre_ids.append(link[1])
+            link = next(links, None)
+        yield ['movie', *row, genre_ids]
+    if include_comments:
+        for row in Comment.objects.using(using).order_by('id').values_list(*FIELDS['comment']).iterator(chunk_size):
+            yield ['comment', *row]
+
+
+def export_catalog(
+        snapshot: IO[str], include_comments: bool = False, chunk_size: int = 2000, using: str = DEFAULT_DB_ALIAS
+) -> Dict[str, int]:
+    """Write genres, movies with their genre links and optionally comments to snapshot, one JSON record per line.
+
+    The first line is a header with the fields of each record type. Returns the number of records of each type.
+    """
+    counts = {'genre': 0, 'movie': 0, 'comment': 0}
+    snapshot.write(json.dumps({
+        'format': FORMAT, 'version': VERSION, 'exported_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+        'fields': {**FIELDS, 'movie': FIELDS['movie'] + ['genre_ids']}
+    }) + '\n')
+    for record in iterate_records(include_comments, chunk_size, using):
+        snapshot.write(json.dumps(record, default=encode_value, ensure_ascii=False, separators=(',', ':')) + '\n')
+        counts[record[0]] += 1
+    return counts
+
+
+def read_records(snapshot: IO[str]) -> Iterator[Dict[str, Any]]:
+    """Yield the records of a snapshot as dicts of values by field, with their type under the type key."""
+    try:
+        header = json.loads(snapshot.readline() or 'null')
+    except (OSError, EOFError, ValueError) as e:
+        raise SnapshotError(f'not a catalogue snapshot: {e}')
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise SnapshotError('not a catalogue snapshot')
+    if header.get('version') != VERSION:
+        raise SnapshotError(f'unsupported snapshot version {header.get("version")!r}, expected {VERSION}')
+    fields = header['fields']
+    try:
+        for line_number, line in enumerate(snapshot, 2):
+            record_type, *values = json.loads(line)
+            if record_type not in fields:
+                raise SnapshotError(f'unknown record type {record_type!r} on line {line_number}')
+            yield {'type': record_type, **dict(zip(fields[record_type], values))}
+    except (OSError, EOFError, ValueError) as e:
+        raise SnapshotError(f'corrupt snapshot: {e}')
+
+
+def get_converters(model: type, field_names: List[str], connection) -> List[Callable[[Any], Any]]:
+    """Get the functions converting JSON values to database values of each of the model's fields."""
+    converters = []
+    for field_name in field_names:
+        field = model._meta.get_field(field_name)
+        # dates and datetimes are written with isoformat, so they can be parsed back with fromisoformat
+        if isinstance(field, models.DateTimeField):
+            converters.append(lambda value: connection.ops.adapt_datetimefield_value(
+                dt.datetime.fromisoformat(value) if value is not None else None
+            ))
+        elif isinstance(field, models.DateField):
+            converters.append(lambda value: connection.ops.adapt_datefield_value(
+                dt.date.fromisoformat(value) if value is not None else None
+            ))
+        else:
+            # numbers and strings are already what the database driver expects
+            converters.append(lambda value: value)
+    return converters
+
+
+def escape_copy_value(value: Any) -> str:
+    """Escape a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def insert_rows(model: type, field_names: List[str], rows: List[list], connection):
+    """Insert a chunk of rows, with COPY on Postgres and executemany elsewhere.
+
+    Raw inserts rather than bulk_create, which would overwrite creation times with auto_now_add.
+    """
+    if not rows:
+        return
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    columns = ', '.join(quote_name(model._meta.get_field(field_name).column) for field_name in field_names)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            data = ''.join('\t'.join(escape_copy_value(value) for value in row) + '\n' for row in rows)
+            sql = f'COPY {table} ({columns}) FROM STDIN'
+            raw_cursor = cursor.cursor
+            if hasattr(raw_cursor, 'copy_expert'):
+                # psycopg2
+                raw_cursor.copy_expert(sql, io.StringIO(data))
+            else:
+                # psycopg 3
+                with raw_cursor.copy(sql) as copy:
+                    copy.write(data)
+        else:
+            placeholders = ', '.join(['%s'] * len(field_names))
+            cursor.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows)
+
+
+def get_deferred_indexes() -> List[tuple]:
+    """Indexes dropped while importing and rebuilt afterwards, which is much faster than updating them per row."""
+    return [(model, index) for model in (Movie, Comment) for index in model._meta.indexes]
+
+
+def get_existing_index_names(model: type, connection) -> set:
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    return {name for name, constraint in constraints.items() if constraint['index']}
+
+
+def drop_deferred_indexes(connection):
+    """Drop those of the deferred indexes which exist."""
+    with connection.schema_editor() as schema_editor:
+        for model, index in get_deferred_indexes():
+            if index.name in get_existing_index_names(model, connection):
+                schema_editor.remove_index(model, index)
+
+
+def build_deferred_indexes(connection):
+    """Build those of the deferred indexes which are missing, including any left dropped by an interrupted import."""
+    with connection.schema_editor() as schema_editor:
+        for model, index in get_deferred_indexes():
+            if index.name not in get_existing_index_names(model, connection):
+                schema_editor.add_index(model, index)
+
+
+@contextlib.contextmanager
+def import_transaction(using: str):
+    """Run the block in a transaction, with the deferred indexes dropped while it runs and built once it is done.
+
+    On PostgreSQL, they are dropped and built in the same transaction, so that a failed import restores them by rolling
+    back. SQLite's schema editor can't be used in a transaction, so there they are built even if the block fails, and
+    a retry builds any which an interrupted import left dropped.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            drop_deferred_indexes(connection)
+            yield
+            build_deferred_indexes(connection)
+        return
+    drop_deferred_indexes(connection)
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        build_deferred_indexes(connection)
+
+
+def import_catalog(snapshot: IO[str], chunk_size: int = 2000, using: str = DEFAULT_DB_ALIAS) -> Dict[str, int]:
+    """Load a snapshot written by export_catalog into a database without movies or comments.
+
+    Rows are inserted chunk_size at a time in a single transaction, with secondary indexes built once at the end.
+    The daily comment count rollup is rebuilt from the imported comments. Returns the number of rows of each type.
+    """
+    if Movie.objects.using(using).exists() or Comment.objects.using(using).exists():
+        raise SnapshotError('snapshots can only be imported into a database without movies or comments')
+    connection = connections[using]
+    # genres may already be there, as migrating installs the bundled ones
+    existing_genre_ids = set(Genre.objects.using(using).values_list('id', flat=True))
+    field_names = {
+        'genre': FIELDS['genre'], 'movie': FIELDS['movie'], 'genre_link': ['movie_id', 'genre_id'],
+        'comment': FIELDS['comment']
+    }
+    chunks = {record_type: [] for record_type in MODELS}
+    counts = {record_type: 0 for record_type in MODELS}
+
+    def flush(record_type: str):
+        insert_rows(MODELS[record_type], field_names[record_type], chunks[record_type], connection)
+        counts[record_type] += len(chunks[record_type])
+        chunks[record_type] = []
+
+    converters = {
+        record_type: list(zip(field_names[record_type], get_converters(model, field_names[record_type], connection)))
+        for record_type, model in MODELS.items()
+    }
+
+    def add(record_type: str, record: Dict[str, Any]):
+        chunks[record_type].append([convert(record[field_name]) for field_name, convert in converters[record_type]])
+        if len(chunks[record_type]) >= chunk_size:
+            flush(record_type)
+
+    try:
+        with import_transaction(using):
+            for record in read_records(snapshot):
+                record_type = record.pop('type')
+                try:
+                    if record_type == 'genre':
+                        if record['id'] not in existing_genre_ids:
+                            add('genre', record)
+                    elif record_type == 'movie':
+                        add('movie', record)
+                        for genre_id in record['genre_ids']:
+                            add('genre_link', {'movie_id': record['id'], 'genre_id': genre_id})
+                    elif record_type == 'comment':
+                        add('comment', record)
+                except (KeyError, TypeError, ValueError, ValidationError) as e:
+                    raise SnapshotError(f'invalid {record_type} record {record}: {e}')
+            for record_type in MODELS:
+                flush(record_type)
+            # explicit IDs don't advance sequences
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [Comment, MovieGenre]):
+                    cursor.execute(sql)
+            if counts['comment']:
+                CommentDailyCount.objects.db_manager(using).rebuild()
+            genres.invalidate_registry(using=using)
+            caching.invalidate_all()
+    except IntegrityError as e:
+        # such as a genre link to a genre missing from both the snapshot and the database
+        raise SnapshotError(f'inconsistent snapshot: {e}')
+    return {
+        'genres': counts['genre'], 'movies': counts['movie'], 'genre_links': counts['genre_link'],
+        'comments': counts['comment']
+    }
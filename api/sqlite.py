@@ -0,0 +1,25 @@
+from typing import Dict, List, Union
+from django.conf import settings
+
+# changes the database file rather than the connection, so it is only set by connections which can write
+PERSISTENT_PRAGMAS = ('journal_mode',)
+
+
+def get_pragma_statements(pragmas: Dict[str, Union[str, int]], read_only: bool = False) -> List[str]:
+    """Get the PRAGMA statements tuning a new connection, with query_only set on read-only connections."""
+    statements = [
+        f'PRAGMA {name} = {value}' for name, value in pragmas.items()
+        if not (read_only and name in PERSISTENT_PRAGMAS)
+    ]
+    if read_only:
+        statements.append('PRAGMA query_only = 1')
+    return statements
+
+
+def apply_pragmas(sender, connection, **kwargs):
+    """connection_created receiver tuning new SQLite connections with the SQLITE_PRAGMAS setting."""
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    # on the raw connection, so that the statements don't show up as queries of the request being served
+    for statement in get_pragma_statements(settings.SQLITE_PRAGMAS, connection.settings_dict.get('READ_ONLY', False)):
+        connection.connection.execute(statement)
@@ -1,12 +1,39 @@
+import asyncio
+import datetime as dt
 import json
-from typing import Dict
-from django.test import TestCase
-from api.models import Genre, Movie, Comment
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import importlib.util
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from typing import Dict, List, Tuple
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.db.models import Sum
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from api import caching, genres, ingestion, instrumentation, routing, serialization, snapshots, sqlite, tmdb
+from api.models import Genre, InvalidMovieError, Movie, Comment, CommentDailyCount, TMDbCacheEntry
 from api.views import movies, comments, top
 
 
 class DummyRequest:
-    def __init__(self, *, GET: Dict[str, str] = None, POST: Dict[str, str] = None):
+    def __init__(self, *, GET: Dict[str, str] = None, POST: Dict[str, str] = None, META: Dict[str, str] = None):
+        self.META = META or {}
         if GET is not None:
             self.method = 'GET'
             self.GET = GET
@@ -15,7 +42,58 @@ class DummyRequest:
             self.POST = POST
 
 
+class StubTMDbServer:
+    """Local HTTP server standing in for TMDb, replying with scripted (status, headers, body, delay) responses."""
+
+    def __init__(self, responses: List[Tuple[int, Dict[str, str], dict, float]]):
+        self.responses = list(responses)
+        self.request_count = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.request_count += 1
+                status, headers, body, delay = stub.responses.pop(0) if stub.responses else (404, {}, {}, 0)
+                time.sleep(delay)
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/3'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_movie(movie_id: int, title: str = 'Test') -> Movie:
+    """Create a movie directly in the database, bypassing TMDb."""
+    return Movie.objects.create(
+        id=movie_id, overview='', release_date='2000-01-01', original_title=title, original_language='en',
+        title=title, popularity=1.0, vote_count=1, vote_average=5.0
+    )
+
+
 class EndpointsTestCase(TestCase):
+    def test_health(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/health')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'ok'})
+
     def test_add_movie(self):
         response = movies(DummyRequest(POST={'title': 'godfather'}))
         expected_response_data = {
@@ -37,6 +115,11 @@ class EndpointsTestCase(TestCase):
         for key in expected_response_data:
             self.assertEqual(actual_response_data[key], expected_response_data[key])
 
+    def test_add_movie_tmdb_unavailable(self):
+        with mock.patch('api.tmdb.asearch_movie', side_effect=tmdb.TMDbUnavailableError('TMDb is unavailable')):
+            response = movies(DummyRequest(POST={'title': 'unavailable'}))
+        self.assertEqual(response.status_code, 503)
+
     def test_get_movie(self):
         Movie.objects.update_or_create_from_tmdb('godfather')
         response = movies(DummyRequest(GET={'title': 'godfather'}))
@@ -108,3 +191,1065 @@ class EndpointsTestCase(TestCase):
         actual_response_data = json.loads(response.getvalue())
         self.assertEqual(response.status_code, 200)
         self.assertEqual(actual_response_data, expected_response_data)
+
+    def test_get_top_max_rank(self):
+        for movie_id in (1, 2, 3, 4):
+            create_movie(movie_id)
+        for movie_id, comment_count in ((1, 1), (2, 3), (3, 1), (4, 2)):
+            for _ in range(comment_count):
+                Comment.objects.create(movie_id=movie_id, text='Tremendous')
+        with CaptureQueriesContext(connection) as context:
+            response = top(DummyRequest(GET={'start_date': '1970-01-01', 'end_date': '2070-01-01', 'max_rank': '2'}))
+        self.assertEqual(len(context.captured_queries), 1)
+        # the comment totals are aggregated once, rather than again in subqueries finding the cutoff of the last rank
+        self.assertEqual(context.captured_queries[0]['sql'].count('FROM "api_movie"'), 1)
+        expected_response_data = [
+            {
+                'movie_id': 2,
+                'total_comments': 3,
+                'rank': 1
+            },
+            {
+                'movie_id': 4,
+                'total_comments': 2,
+                'rank': 2
+            }
+        ]
+        actual_response_data = json.loads(response.getvalue())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(actual_response_data, expected_response_data)
+
+    def test_get_top_max_rank_without_window_functions(self):
+        for movie_id, comment_count in ((1, 1), (2, 3), (3, 1), (4, 2)):
+            create_movie(movie_id)
+            for _ in range(comment_count):
+                Comment.objects.create(movie_id=movie_id, text='Tremendous')
+        with mock.patch.object(connection.features, 'supports_over_clause', False):
+            ranking = Movie.objects.all().top('1970-01-01', '2070-01-01', max_rank=2)
+        self.assertEqual(ranking, [
+            {'movie_id': 2, 'total_comments': 3, 'rank': 1}, {'movie_id': 4, 'total_comments': 2, 'rank': 2}
+        ])
+
+    def test_get_movies_query_count(self):
+        for movie_id in range(1, 11):
+            create_movie(movie_id).genres.set([18, 80])
+        genres.get_registry().load()
+        # one query for the movies and one for all of their genre IDs, regardless of the number of movies
+        with self.assertNumQueries(2):
+            response = movies(DummyRequest(GET={'order_by': 'id'}))
+        actual_response_data = json.loads(response.getvalue())
+        self.assertEqual(len(actual_response_data), 10)
+        self.assertEqual(actual_response_data[0]['genres'], [{'id': 18, 'name': 'Drama'}, {'id': 80, 'name': 'Crime'}])
+
+    def test_get_comments_query_count(self):
+        for movie_id in range(1, 11):
+            create_movie(movie_id)
+            Comment.objects.create(movie_id=movie_id, text='Tremendous')
+        with self.assertNumQueries(1):
+            response = comments(DummyRequest(GET={}))
+        self.assertEqual(len(json.loads(response.getvalue())), 10)
+
+    def test_get_movies_paginated(self):
+        for movie_id in range(1, 26):
+            movie = create_movie(movie_id, f'Movie {movie_id}')
+            Movie.objects.filter(id=movie.id).update(popularity=movie_id % 4)
+        expected_movie_ids = list(Movie.objects.order_by('-popularity', 'title', 'id').values_list('id', flat=True))
+        actual_movie_ids = []
+        cursor = None
+        while True:
+            query = {'order_by': '-popularity,title', 'limit': '7'}
+            if cursor:
+                query['cursor'] = cursor
+            # every page costs the same, no matter how deep
+            with self.assertNumQueries(2):
+                response = movies(DummyRequest(GET=query))
+            self.assertEqual(response.status_code, 200)
+            actual_response_data = json.loads(response.getvalue())
+            actual_movie_ids += [movie['id'] for movie in actual_response_data['results']]
+            cursor = actual_response_data['next']
+            if not cursor:
+                break
+        self.assertEqual(actual_movie_ids, expected_movie_ids)
+
+    def test_get_movies_paginated_invalid_cursor(self):
+        create_movie(1)
+        create_movie(2)
+        response = movies(DummyRequest(GET={'order_by': 'title', 'limit': '1'}))
+        cursor = json.loads(response.getvalue())['next']
+        self.assertEqual(movies(DummyRequest(GET={'order_by': 'popularity', 'cursor': cursor})).status_code, 422)
+        self.assertEqual(movies(DummyRequest(GET={'cursor': 'garbage'})).status_code, 422)
+        self.assertEqual(movies(DummyRequest(GET={'limit': '0'})).status_code, 422)
+
+    def test_get_comments_paginated(self):
+        create_movie(1)
+        for _ in range(5):
+            Comment.objects.create(movie_id=1, text='Tremendous')
+        response = comments(DummyRequest(GET={'movie_id': '1', 'limit': '3'}))
+        first_page = json.loads(response.getvalue())
+        response = comments(DummyRequest(GET={'movie_id': '1', 'limit': '3', 'cursor': first_page['next']}))
+        second_page = json.loads(response.getvalue())
+        self.assertEqual(
+            [comment['id'] for comment in first_page['results'] + second_page['results']],
+            list(Comment.objects.order_by('created_at', 'id').values_list('id', flat=True))
+        )
+        self.assertIsNone(second_page['next'])
+
+    def test_get_movies_streamed(self):
+        Genre.objects.bulk_create([Genre(id=1, name='Drama')], ignore_conflicts=True)
+        for movie_id in range(1, 6):
+            create_movie(movie_id).genres.set([1])
+        response = movies(DummyRequest(GET={'order_by': 'id'}))
+        streaming_response = movies(DummyRequest(GET={'order_by': 'id', 'stream': '1'}))
+        self.assertTrue(streaming_response.streaming)
+        self.assertEqual(streaming_response.getvalue(), response.getvalue())
+
+    def test_get_comments_streamed_ndjson(self):
+        create_movie(1)
+        for _ in range(3):
+            Comment.objects.create(movie_id=1, text='Tremendous')
+        response = comments(DummyRequest(GET={}, META={'HTTP_ACCEPT': 'application/x-ndjson'}))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = response.getvalue().decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2, 3])
+
+    def test_streamed_over_asgi(self):
+        create_movie(1)
+        for _ in range(3):
+            Comment.objects.create(movie_id=1, text='Tremendous')
+
+        async def get_chunks() -> List[bytes]:
+            response = await self.async_client.get('/comments', {'stream': 'ndjson'})
+            self.assertTrue(response.is_async)
+            return [chunk async for chunk in response.streaming_content]
+
+        # fetched a chunk at a time rather than buffered whole, which Django warns about
+        with mock.patch('api.views.STREAM_CHUNK_SIZE', 2), warnings.catch_warnings():
+            warnings.simplefilter('error')
+            chunks = async_to_sync(get_chunks)()
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([json.loads(line)['id'] for line in b''.join(chunks).splitlines()], [1, 2, 3])
+
+    def test_add_movies_bulk(self):
+        Genre.objects.bulk_create([Genre(id=18, name='Drama'), Genre(id=80, name='Crime')], ignore_conflicts=True)
+        create_movie(2, 'Second')
+        raw_movies = {
+            'first': {
+                'id': 1, 'overview': '', 'release_date': '2000-01-01', 'genre_ids': [18, 80, 999],
+                'original_title': 'First', 'original_language': 'en', 'title': 'First', 'popularity': 1.0,
+                'vote_count': 1, 'vote_average': 5.0
+            },
+            'second': {
+                'id': 2, 'overview': '', 'release_date': '2000-01-01', 'genre_ids': [18], 'original_title': 'Second',
+                'original_language': 'en', 'title': 'Second', 'popularity': 9.0, 'vote_count': 2, 'vote_average': 6.0
+            },
+            'unreleased': {'id': 3, 'release_date': ''}
+        }
+
+        def search_movie(title: str) -> dict:
+            if title == 'unavailable':
+                raise tmdb.TMDbUnavailableError('TMDb is unavailable')
+            return raw_movies.get(title)
+
+        with mock.patch('api.tmdb.asearch_movie', side_effect=search_movie):
+            response = self.client.post('/movies/bulk', {
+                'title': ['first', 'second', 'unknown', 'unavailable', 'unreleased', 'first']
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [
+            {'title': 'first', 'status': 'created', 'movie_id': 1},
+            {'title': 'second', 'status': 'updated', 'movie_id': 2},
+            {'title': 'unknown', 'status': 'not_found', 'movie_id': None},
+            {'title': 'unavailable', 'status': 'unavailable', 'movie_id': None},
+            {'title': 'unreleased', 'status': 'invalid', 'movie_id': 3}
+        ])
+        self.assertEqual(list(Movie.objects.get(id=1).genres.values_list('id', flat=True)), [18, 80])
+        self.assertEqual(Movie.objects.get(id=2).popularity, 9.0)
+        self.assertEqual(self.client.post('/movies/bulk', {}).status_code, 422)
+
+    def test_search_movies(self):
+        for movie_id, title, original_title in (
+                (1, 'The Godfather', 'The Godfather'), (2, 'The Godfather Part II', 'The Godfather Part II'),
+                (3, 'Spirited Away', '千と千尋の神隠し'), (4, 'Godzilla', 'ゴジラ'),
+                (5, 'Father of the Bride', 'Father of the Bride')
+        ):
+            create_movie(movie_id, title)
+            Movie.objects.filter(id=movie_id).update(original_title=original_title)
+        cases = (
+            ('godfather', 'substring', [1, 2]),
+            ('BRIDE', 'substring', [5]),
+            ('father', 'prefix', [5]),
+            ('godfahter part', 'fuzzy', [2, 1]),
+            ('the godfather', 'exact', [1]),
+            ('神隠し', 'substring', [3]),
+            ('go', 'substring', [1, 2, 4])
+        )
+        for query, search_mode, expected_movie_ids in cases:
+            with self.subTest(query=query, search_mode=search_mode):
+                response = movies(DummyRequest(GET={'title': query, 'search_mode': search_mode}))
+                actual_movie_ids = [movie['id'] for movie in json.loads(response.getvalue())]
+                self.assertEqual(actual_movie_ids[:len(expected_movie_ids)], expected_movie_ids)
+                if search_mode != 'fuzzy':
+                    self.assertEqual(len(actual_movie_ids), len(expected_movie_ids))
+        self.assertEqual(movies(DummyRequest(GET={'title': 'x', 'search_mode': 'psychic'})).status_code, 422)
+
+    def test_search_movies_paginated(self):
+        for movie_id, title in (
+                (1, 'The Godfather'), (2, 'The Godfather Part II'), (3, 'The Godfather Part III'), (4, 'Godzilla'),
+                (5, 'Father of the Bride')
+        ):
+            create_movie(movie_id, title)
+        for query, search_mode in (('godfahter part ii', 'fuzzy'), ('god', 'substring')):
+            with self.subTest(query=query, search_mode=search_mode):
+                GET = {'title': query, 'search_mode': search_mode}
+                expected_movie_ids = [movie['id'] for movie in json.loads(movies(DummyRequest(GET=GET)).getvalue())]
+                # pages follow the relevance ranking, rather than IDs
+                movie_ids = []
+                cursor = None
+                while True:
+                    response = movies(DummyRequest(GET={**GET, 'limit': '1', 'cursor': cursor or ''}))
+                    page = json.loads(response.getvalue())
+                    movie_ids.extend(movie['id'] for movie in page['results'])
+                    cursor = page['next']
+                    if not cursor:
+                        break
+                self.assertEqual(movie_ids, expected_movie_ids)
+                self.assertNotEqual(expected_movie_ids, sorted(expected_movie_ids))
+
+
+class SerializationTestCase(TestCase):
+    def setUp(self):
+        Genre.objects.bulk_create([Genre(id=18, name='Drama'), Genre(id=80, name='Crime')], ignore_conflicts=True)
+        for movie_id in range(1, 4):
+            create_movie(movie_id, f'Movie {movie_id} – Ünïcode').genres.set([18, 80][:movie_id - 1])
+            Comment.objects.create(movie_id=movie_id, text='Tremendous – “quoted”')
+
+    def tearDown(self):
+        serialization.reset_json_backend()
+
+    def assert_same_as_to_dict(self, json_backend: str, compare_bytes: bool):
+        with override_settings(JSON_BACKEND=json_backend):
+            serialization.reset_json_backend()
+            for queryset in (Movie.objects.order_by('id'), Comment.objects.order_by('id')):
+                expected_content = JsonResponse([obj.to_dict() for obj in queryset], safe=False).content
+                actual_content = serialization.encode_json(serialization.serialize(queryset))
+                if compare_bytes:
+                    self.assertEqual(actual_content, expected_content)
+                else:
+                    self.assertEqual(json.loads(actual_content), json.loads(expected_content))
+
+    def test_stdlib(self):
+        self.assert_same_as_to_dict('stdlib', compare_bytes=True)
+
+    def test_stdlib_by_default(self):
+        # orjson changes the output format, so it is only used when asked for
+        self.assertEqual(settings.JSON_BACKEND, 'stdlib')
+        self.assertEqual(serialization.get_json_backend().name, 'stdlib')
+
+    @skipUnless(importlib.util.find_spec('orjson'), 'orjson is not installed')
+    def test_orjson(self):
+        self.assert_same_as_to_dict('orjson', compare_bytes=False)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'responses': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-responses'}
+})
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        caches[caching.CACHE_ALIAS].clear()
+        for movie_id in (1, 2):
+            create_movie(movie_id)
+
+    def add_comment(self, movie_id: int):
+        with self.captureOnCommitCallbacks(execute=True):
+            comments(DummyRequest(POST={'movie_id': str(movie_id), 'text': 'Tremendous'}))
+
+    def test_comments_invalidated_per_movie(self):
+        self.add_comment(1)
+        self.assertEqual(len(json.loads(comments(DummyRequest(GET={'movie_id': '1'})).getvalue())), 1)
+        with self.assertNumQueries(0):
+            comments(DummyRequest(GET={'movie_id': '1'}))
+        self.add_comment(2)
+        # comments of other movies are still cached
+        with self.assertNumQueries(0):
+            comments(DummyRequest(GET={'movie_id': '1'}))
+        self.add_comment(1)
+        self.assertEqual(len(json.loads(comments(DummyRequest(GET={'movie_id': '1'})).getvalue())), 2)
+
+    def test_top_invalidated_only_when_including_today(self):
+        today = dt.datetime.now(dt.timezone.utc).date()
+        current_query = {'start_date': '2019-01-01', 'end_date': (today + dt.timedelta(days=1)).isoformat()}
+        past_query = {'start_date': '2019-01-01', 'end_date': '2019-12-31'}
+        top(DummyRequest(GET=current_query))
+        top(DummyRequest(GET=past_query))
+        self.add_comment(2)
+        with self.assertNumQueries(0):
+            top(DummyRequest(GET=past_query))
+        self.assertEqual(json.loads(top(DummyRequest(GET=current_query)).getvalue())[0]['movie_id'], 2)
+
+    def test_top_dates_without_zero_padding(self):
+        # 2030-10-9 sorts after 2030-10-17 as a string
+        unpadded_query = {'start_date': '2030-10-9', 'end_date': '2030-10-31'}
+        with mock.patch('django.utils.timezone.now', return_value=dt.datetime(2030, 10, 17, tzinfo=dt.timezone.utc)):
+            self.add_comment(2)
+            self.assertEqual(json.loads(top(DummyRequest(GET=unpadded_query)).getvalue())[0]['total_comments'], 1)
+            self.add_comment(2)
+            self.assertEqual(json.loads(top(DummyRequest(GET=unpadded_query)).getvalue())[0]['total_comments'], 2)
+
+    def test_streamed_representation_not_served_from_cache(self):
+        response = self.client.get('/movies')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['Vary'], 'Accept')
+        response = self.client.get('/movies', HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 2)
+
+    def test_not_modified(self):
+        response = movies(DummyRequest(GET={}))
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = movies(DummyRequest(GET={}, META={'HTTP_IF_NONE_MATCH': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        create_movie(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            caching.invalidate_movies()
+        response = movies(DummyRequest(GET={}, META={'HTTP_IF_NONE_MATCH': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        for movie_id in range(1, 5):
+            create_movie(movie_id)
+            Comment.objects.create(movie_id=movie_id, text='Tremendous')
+
+    def explain(self, sql: str) -> List[str]:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # tiny test tables are cheaper to scan, so make the planner use indexes whenever it can
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                return [row[0] for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assert_uses_index(self, view, GET: Dict[str, str], table: str, alias: str = None):
+        """Assert that the main (first) query of the view reads the table (joined as alias) through an index."""
+        with CaptureQueriesContext(connection) as context:
+            view(DummyRequest(GET=GET))
+        plan = self.explain(context.captured_queries[0]['sql'])
+        if connection.vendor == 'postgresql':
+            self.assertFalse([line for line in plan if f'Seq Scan on {table}' in line], plan)
+            self.assertTrue([line for line in plan if 'Index' in line], plan)
+        else:
+            table_lines = [line for line in plan if re.search(rf'\b{alias or table}\b', line)]
+            self.assertTrue(table_lines, plan)
+            self.assertTrue(all('INDEX' in line or 'PRIMARY KEY' in line for line in table_lines), plan)
+
+    def test_get_comments_uses_index(self):
+        self.assert_uses_index(comments, {'movie_id': '1'}, 'api_comment')
+        self.assert_uses_index(comments, {'movie_id': '1', 'limit': '2'}, 'api_comment')
+        self.assert_uses_index(comments, {'limit': '2'}, 'api_comment')
+
+    def test_get_movies_uses_index(self):
+        for order_by in ('-popularity', 'release_date', '-vote_average'):
+            with self.subTest(order_by=order_by):
+                self.assert_uses_index(movies, {'order_by': order_by, 'limit': '2'}, 'api_movie')
+
+    def test_get_top_uses_index(self):
+        self.assert_uses_index(
+            top, {'start_date': '2019-01-01', 'end_date': '2019-12-31', 'max_rank': '3'}, 'api_commentdailycount',
+            'period_comment_counts'
+        )
+
+    def test_get_top_joins_only_the_period(self):
+        with CaptureQueriesContext(connection) as context:
+            top(DummyRequest(GET={'start_date': '2019-01-01', 'end_date': '2019-12-31', 'max_rank': '3'}))
+        sql = context.captured_queries[0]['sql']
+        # the date range is part of the join, rather than only filtering rollup rows of every day inside the aggregate
+        join_condition = re.search(r'LEFT OUTER JOIN "api_commentdailycount" (?:\S+ )?ON \((.*)\) GROUP BY', sql)
+        self.assertIsNotNone(join_condition, sql)
+        self.assertIn('BETWEEN', join_condition.group(1))
+        self.assertNotIn('FILTER (WHERE', sql)
+        self.assertNotIn('CASE WHEN', sql)
+        if connection.vendor == 'sqlite':
+            self.assertTrue([line for line in self.explain(sql) if 'movie_id=? AND day>? AND day<?' in line])
+
+
+class MovieManagerTestCase(TestCase):
+    def setUp(self):
+        genres.reset_registry()
+        Genre.objects.bulk_create([Genre(id=18, name='Drama'), Genre(id=80, name='Crime')], ignore_conflicts=True)
+        self.raw_movie = {
+            'id': 1, 'overview': '', 'release_date': '2000-01-01', 'genre_ids': [18, 80, 999],
+            'original_title': 'First', 'original_language': 'en', 'title': 'First', 'popularity': 1.0,
+            'vote_count': 1, 'vote_average': 5.0
+        }
+
+    def test_upsert_from_tmdb(self):
+        movie, created, changed = Movie.objects.upsert_from_tmdb(self.raw_movie)
+        self.assertTrue(created)
+        self.assertTrue(changed)
+        self.assertEqual(set(movie.genres.values_list('id', flat=True)), {18, 80})
+        # unchanged movies are only read: movie lookup and existing genres, wrapped in a savepoint
+        with self.assertNumQueries(4):
+            movie, created, changed = Movie.objects.upsert_from_tmdb(self.raw_movie)
+        self.assertFalse(created)
+        self.assertFalse(changed)
+
+    def test_upsert_from_tmdb_without_release_date(self):
+        self.raw_movie['release_date'] = ''
+        with self.assertRaises(InvalidMovieError):
+            Movie.objects.upsert_from_tmdb(self.raw_movie)
+        # like the bulk endpoint reports the movie as invalid
+        with mock.patch('api.tmdb.afetch_movie', return_value=self.raw_movie):
+            response = movies(DummyRequest(POST={'title': 'unreleased'}))
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(Movie.objects.exists())
+
+    def test_upsert_from_tmdb_updates_stats(self):
+        Movie.objects.upsert_from_tmdb(self.raw_movie)
+        self.raw_movie.update(popularity=2.5, vote_count=10, vote_average=7.5)
+        # plus a single update of the changed fields
+        with self.assertNumQueries(5):
+            movie, created, changed = Movie.objects.upsert_from_tmdb(self.raw_movie)
+        self.assertFalse(created)
+        self.assertTrue(changed)
+        movie.refresh_from_db()
+        self.assertEqual((movie.popularity, movie.vote_count, movie.vote_average), (2.5, 10, 7.5))
+
+    def test_refresh_movies(self):
+        for movie_id in (1, 2, 3):
+            create_movie(movie_id)
+        Movie.objects.filter(id=1).update(fetched_at=dt.datetime(2019, 1, 1, tzinfo=dt.timezone.utc))
+        Movie.objects.filter(id=3).update(fetched_at=dt.datetime.now(dt.timezone.utc))
+        self.assertEqual(
+            list(Movie.objects.stale(dt.timedelta(hours=1)).values_list('id', flat=True)), [2, 1]
+        )
+
+        def fetch_movie_details(movie_id: int) -> dict:
+            if movie_id == 1:
+                raise tmdb.TMDbNotFoundError('TMDb resource movie/1 does not exist')
+            return {'id': movie_id, 'popularity': 9.0, 'vote_count': 99, 'vote_average': 9.9}
+
+        with mock.patch('api.tmdb.fetch_movie_details', side_effect=fetch_movie_details):
+            call_command('refresh_movies', '--once', '--budget', '6000', '--max-age', '1', stdout=StringIO())
+        self.assertEqual(
+            list(Movie.objects.order_by('id').values_list('popularity', 'vote_count', 'vote_average')),
+            [(1.0, 1, 5.0), (9.0, 99, 9.9), (1.0, 1, 5.0)]
+        )
+        self.assertFalse(Movie.objects.stale(dt.timedelta(hours=1)).exists())
+
+
+class GenreRegistryTestCase(TestCase):
+    def setUp(self):
+        genres.reset_registry()
+
+    def test_bundled_genres(self):
+        bundled_genres = sorted(genres.load_fixture(), key=lambda genre: genre['id'])
+        self.assertEqual(len(bundled_genres), 19)
+        self.assertEqual(list(Genre.objects.order_by('id').values('id', 'name')), bundled_genres)
+
+    def test_lookups_without_queries(self):
+        registry = genres.get_registry()
+        registry.load()
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_dicts([80, 18]), [{'id': 80, 'name': 'Crime'}, {'id': 18, 'name': 'Drama'}])
+            self.assertEqual(registry.get_known_ids([18, 999]), {18})
+        movie = create_movie(1)
+        movie.genres.set([18, 80])
+        movie.genre_ids = [18, 80]
+        with self.assertNumQueries(0):
+            self.assertEqual(movie.to_dict()['genres'], [{'id': 18, 'name': 'Drama'}, {'id': 80, 'name': 'Crime'}])
+
+    def test_refreshed_on_change(self):
+        registry = genres.get_registry()
+        registry.load()
+        Genre.objects.create(id=999, name='Noir')
+        self.assertEqual(registry.get_known_ids([999]), {999})
+        Genre.objects.filter(id=999).update(name='Film Noir')
+        # IDs coming from the database are always resolved
+        Genre.objects.bulk_create([Genre(id=1000, name='Giallo')])
+        self.assertEqual(registry.get_dicts([999, 1000]), [
+            {'id': 999, 'name': 'Film Noir'}, {'id': 1000, 'name': 'Giallo'}
+        ])
+
+    def test_sync_genres(self):
+        registry = genres.get_registry()
+        registry.load()
+        raw_genres = [{'id': 18, 'name': 'Drama'}, {'id': 80, 'name': 'Crime Story'}, {'id': 999, 'name': 'Noir'}]
+        with mock.patch('api.tmdb.fetch_genres', return_value=raw_genres):
+            stdout = StringIO()
+            call_command('sync_genres', stdout=stdout)
+        self.assertIn('Added 1 genres and renamed 1', stdout.getvalue())
+        self.assertEqual(
+            registry.get_dicts([80, 999]), [{'id': 80, 'name': 'Crime Story'}, {'id': 999, 'name': 'Noir'}]
+        )
+        with mock.patch('api.tmdb.fetch_genres', side_effect=tmdb.TMDbUnavailableError('TMDb is unavailable')):
+            with self.assertRaises(CommandError):
+                call_command('sync_genres', stdout=StringIO())
+
+    def test_api_key_needed_only_for_calls(self):
+        tmdb.reset_client()
+        with override_settings(TMDB_CLIENT={**settings.TMDB_CLIENT, 'API_KEY': ''}):
+            with self.assertRaises(ImproperlyConfigured):
+                tmdb.get_client()
+        tmdb.reset_client()
+
+
+class CommentDailyCountTestCase(TestCase):
+    def test_comments_increment_rollup(self):
+        create_movie(1)
+        Comment.objects.create(movie_id=1, text='Tremendous')
+        Comment.objects.create(movie_id=1, text='Horrendous')
+        daily_count = CommentDailyCount.objects.get()
+        self.assertEqual(daily_count.movie_id, 1)
+        self.assertEqual(daily_count.count, 2)
+        self.assertEqual(CommentDailyCount.objects.find_inconsistencies(), [])
+
+    def test_check_and_rebuild(self):
+        create_movie(1)
+        comment = Comment.objects.create(movie_id=1, text='Tremendous')
+        day = comment.created_at.date()
+        Comment.objects.filter(id=comment.id).update(created_at=comment.created_at - dt.timedelta(days=1))
+        self.assertEqual(
+            CommentDailyCount.objects.find_inconsistencies(),
+            [(1, day - dt.timedelta(days=1), 1, 0), (1, day, 0, 1)]
+        )
+        with self.assertRaises(CommandError):
+            call_command('check_comment_counts', stdout=StringIO())
+        call_command('rebuild_comment_counts', stdout=StringIO())
+        call_command('check_comment_counts', stdout=StringIO())
+        self.assertEqual(CommentDailyCount.objects.get().day, day - dt.timedelta(days=1))
+
+
+class CommentIngestionTestCase(TransactionTestCase):
+    def setUp(self):
+        create_movie(1)
+        create_movie(2)
+
+    def tearDown(self):
+        ingestion.reset_ingester()
+
+    def test_group_commit(self):
+        ingester = ingestion.CommentIngester(max_batch_size=10, max_delay=0.05)
+        ingester.start()
+        futures = [ingester.submit(1 + index % 2, 'Tremendous') for index in range(25)]
+        comments = [future.result(timeout=5) for future in futures]
+        ingester.stop()
+        self.assertEqual(
+            sorted(comment.id for comment in comments),
+            list(Comment.objects.order_by('id').values_list('id', flat=True))
+        )
+        self.assertEqual(
+            dict(CommentDailyCount.objects.values_list('movie_id').annotate(total=Sum('count'))),
+            {1: 13, 2: 12}
+        )
+        with self.assertRaises(ingestion.IngesterStoppedError):
+            ingester.submit(1, 'Too late')
+
+    def test_backpressure_and_flush_on_stop(self):
+        ingester = ingestion.CommentIngester(queue_size=2, enqueue_timeout=0)
+        ingester.submit(1, 'First')
+        ingester.submit(1, 'Second')
+        with self.assertRaises(ingestion.QueueFullError):
+            ingester.submit(1, 'Third')
+        ingester.start()
+        ingester.stop()
+        self.assertEqual(list(Comment.objects.order_by('id').values_list('text', flat=True)), ['First', 'Second'])
+
+    def test_stop_while_submitting(self):
+        ingester = ingestion.CommentIngester()
+        ingester.start()
+        submitting = threading.Event()
+        put = ingester._queue.put
+
+        def slow_put(item, *args, **kwargs):
+            if item is not ingestion._STOP:
+                submitting.set()
+                time.sleep(0.1)
+            put(item, *args, **kwargs)
+
+        with mock.patch.object(ingester._queue, 'put', side_effect=slow_put):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                submission = executor.submit(ingester.submit, 1, 'Just in time')
+                submitting.wait(5)
+                ingester.stop()
+                # written rather than left in the queue of a stopped flusher
+                comment = submission.result().result(timeout=5)
+        self.assertEqual(Comment.objects.get().id, comment.id)
+
+    def test_endpoint(self):
+        config = {
+            'MAX_BATCH_SIZE': 500, 'MAX_DELAY': 0.01, 'QUEUE_SIZE': 100, 'ENQUEUE_TIMEOUT': 1, 'SHUTDOWN_TIMEOUT': 10
+        }
+        with override_settings(COMMENT_INGESTION={'MODE': 'group_commit', **config}):
+            response = self.client.post('/comments', {'movie_id': '1', 'text': 'Tremendous'})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json()['id'], Comment.objects.get().id)
+            self.assertEqual(self.client.post('/comments', {'movie_id': '3', 'text': 'Nope'}).status_code, 422)
+        ingestion.reset_ingester()
+        with override_settings(COMMENT_INGESTION={'MODE': 'deferred', **config}):
+            response = self.client.post('/comments', {'movie_id': '2', 'text': 'Tremendous'})
+            self.assertEqual(response.status_code, 202)
+            ingestion.reset_ingester()
+        self.assertEqual(Comment.objects.filter(movie_id=2).count(), 1)
+
+
+# as importing drops and rebuilds indexes, which SQLite can't do within the atomic block of a TestCase
+class CatalogSnapshotTestCase(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'catalog.jsonl.gz')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        Genre.objects.get_or_create(id=18, defaults={'name': 'Drama'})
+        Genre.objects.get_or_create(id=80, defaults={'name': 'Crime'})
+        create_movie(1, 'The Godfather').genres.set([18, 80])
+        create_movie(2, 'Ça tourne\tà Manhattan\n')
+        comment = Comment.objects.create(movie_id=1, text='Tremendous')
+        Comment.objects.filter(id=comment.id).update(created_at=comment.created_at - dt.timedelta(days=3))
+        Comment.objects.create(movie_id=2, text='Horrendous')
+        CommentDailyCount.objects.rebuild()
+        movies = list(Movie.objects.order_by('id').values())
+        comments = list(Comment.objects.order_by('id').values())
+        daily_counts = list(CommentDailyCount.objects.order_by('movie_id', 'day').values('movie_id', 'day', 'count'))
+        call_command('export_catalog', self.path, '--comments', stderr=StringIO())
+        Movie.objects.all().delete()
+        self.assertEqual(CommentDailyCount.objects.count(), 0)
+        call_command('import_catalog', self.path, '--chunk-size', '1', stdout=StringIO())
+        self.assertEqual(list(Movie.objects.order_by('id').values()), movies)
+        self.assertEqual(list(Comment.objects.order_by('id').values()), comments)
+        self.assertEqual(set(Movie.objects.get(id=1).genres.values_list('id', flat=True)), {18, 80})
+        self.assertEqual(
+            list(CommentDailyCount.objects.order_by('movie_id', 'day').values('movie_id', 'day', 'count')),
+            daily_counts
+        )
+        # sequences continue after the imported IDs
+        self.assertGreater(Comment.objects.create(movie_id=2, text='Tremendous').id, comments[-1]['id'])
+        with self.assertRaises(CommandError):
+            call_command('import_catalog', self.path, stdout=StringIO())
+
+    def get_index_names(self) -> set:
+        return {
+            index_name for model in (Movie, Comment)
+            for index_name in snapshots.get_existing_index_names(model, connection)
+        }
+
+    def test_indexes_restored(self):
+        deferred_index_names = {index.name for _, index in snapshots.get_deferred_indexes()}
+        create_movie(1)
+        call_command('export_catalog', self.path, stderr=StringIO())
+        Movie.objects.all().delete()
+        # as if an earlier import had been interrupted after dropping an index
+        model, index = snapshots.get_deferred_indexes()[0]
+        with connection.schema_editor() as schema_editor:
+            schema_editor.remove_index(model, index)
+        with mock.patch('api.snapshots.insert_rows', side_effect=sqlite3.OperationalError('disk I/O error')):
+            with self.assertRaises(sqlite3.OperationalError):
+                call_command('import_catalog', self.path, stdout=StringIO())
+        self.assertEqual(Movie.objects.count(), 0)
+        self.assertLessEqual(deferred_index_names, self.get_index_names())
+        call_command('import_catalog', self.path, stdout=StringIO())
+        self.assertEqual(Movie.objects.count(), 1)
+        self.assertLessEqual(deferred_index_names, self.get_index_names())
+
+    def test_invalid_snapshot(self):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'not gzip')
+        with self.assertRaises(CommandError):
+            call_command('import_catalog', self.path, stdout=StringIO())
+        with snapshots.open_snapshot(self.path, 'w') as snapshot:
+            snapshot.write(json.dumps({'format': snapshots.FORMAT, 'version': snapshots.VERSION + 1}) + '\n')
+        with self.assertRaises(CommandError):
+            call_command('import_catalog', self.path, stdout=StringIO())
+        self.assertEqual(Movie.objects.count(), 0)
+
+    def test_unknown_genre(self):
+        Genre.objects.get_or_create(id=18, defaults={'name': 'Drama'})
+        create_movie(1).genres.set([18])
+        call_command('export_catalog', self.path, stderr=StringIO())
+        Movie.objects.all().delete()
+        with snapshots.open_snapshot(self.path, 'r') as snapshot:
+            records = [json.loads(line) for line in snapshot]
+        with snapshots.open_snapshot(self.path, 'w') as snapshot:
+            for record in records:
+                # genre IDs being the last field of movies
+                if isinstance(record, list) and record[0] == 'movie':
+                    record[-1] = [0]
+                snapshot.write(json.dumps(record) + '\n')
+        with self.assertRaisesRegex(CommandError, 'inconsistent snapshot'):
+            call_command('import_catalog', self.path, stdout=StringIO())
+        self.assertEqual(Movie.objects.count(), 0)
+
+
+class TMDbCacheTestCase(TestCase):
+    def tearDown(self):
+        tmdb.reset_cache()
+
+    def assert_cached(self, backend: str):
+        with override_settings(TMDB_CACHE={'BACKEND': backend, 'TTL': 60, 'NEGATIVE_TTL': 60, 'MAX_SIZE': 10}):
+            tmdb.reset_cache()
+            with mock.patch('api.tmdb.search_movie', side_effect=lambda title: {'id': 1, 'title': title}) as search:
+                self.assertEqual(tmdb.fetch_movie('The  Godfather'), {'id': 1, 'title': 'The  Godfather'})
+                self.assertEqual(tmdb.fetch_movie('the godfather '), {'id': 1, 'title': 'The  Godfather'})
+                self.assertEqual(search.call_count, 1)
+            with mock.patch('api.tmdb.search_movie', return_value=None) as search:
+                self.assertIsNone(tmdb.fetch_movie('nonexistent'))
+                self.assertIsNone(tmdb.fetch_movie('Nonexistent'))
+                self.assertEqual(search.call_count, 1)
+            self.assertEqual(tmdb.get_cache().stats(), {'hits': 2, 'misses': 2})
+            tmdb.get_cache().clear()
+
+    def test_memory_cache(self):
+        self.assert_cached('memory')
+
+    def test_django_cache(self):
+        # keys must be valid for any cache, memcached included
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            self.assert_cached('django')
+
+    def test_database_cache(self):
+        self.assert_cached('database')
+
+    def test_database_cache_long_key(self):
+        # keyed on a fixed-length digest, however long the title
+        with override_settings(TMDB_CACHE={'BACKEND': 'database', 'TTL': 60, 'NEGATIVE_TTL': 60, 'MAX_SIZE': 10}):
+            tmdb.reset_cache()
+            title = 'The Godfather ' * 100
+            with mock.patch('api.tmdb.search_movie', return_value={'id': 238}):
+                tmdb.fetch_movie(title)
+        entry = TMDbCacheEntry.objects.get()
+        self.assertEqual(len(entry.key), 32)
+        self.assertEqual(entry.query, f'search/movie:{tmdb.normalize_query(title)}')
+        self.assertEqual(entry.value, {'id': 238})
+
+    def test_concurrent_fetches_coalesced(self):
+        search_count = 0
+
+        async def search_movie(title: str) -> dict:
+            nonlocal search_count
+            search_count += 1
+            await asyncio.sleep(0.1)
+            return {'id': 1, 'title': title}
+
+        async def fetch_concurrently() -> List[dict]:
+            return await asyncio.gather(*(tmdb.afetch_movie(title) for title in ['Up', 'up', 'UP ', 'Cars']))
+
+        with override_settings(TMDB_CACHE={'BACKEND': 'memory', 'TTL': 60, 'NEGATIVE_TTL': 60, 'MAX_SIZE': 10}):
+            tmdb.reset_cache()
+            with mock.patch('api.tmdb.asearch_movie', side_effect=search_movie):
+                fetched_movies = async_to_sync(fetch_concurrently)()
+        self.assertEqual([movie['title'] for movie in fetched_movies], ['Up', 'Up', 'Up', 'Cars'])
+        self.assertEqual(search_count, 2)
+
+    def test_fetches_coalesced_across_requests(self):
+        search_count = 0
+
+        def search_movie(title: str) -> dict:
+            nonlocal search_count
+            search_count += 1
+            time.sleep(0.1)
+            return {'id': 1, 'title': 'Up'}
+
+        def fetch_in_request(title: str) -> dict:
+            # like an async view served over WSGI, on an event loop of its own
+            return async_to_sync(tmdb.afetch_movie)(title)
+
+        # coalesced without a cache too
+        with override_settings(TMDB_CACHE={'BACKEND': 'none', 'TTL': 60, 'NEGATIVE_TTL': 60, 'MAX_SIZE': 10}):
+            tmdb.reset_cache()
+            with mock.patch('api.tmdb.search_movie', side_effect=search_movie):
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    fetched_movies = list(executor.map(fetch_in_request, ['Up', 'up', 'UP ']))
+        self.assertEqual([movie['title'] for movie in fetched_movies], ['Up', 'Up', 'Up'])
+        self.assertEqual(search_count, 1)
+        # through the shared client, rather than an async client per event loop
+        self.assertEqual(len(tmdb._async_clients), 0)
+
+    def test_memory_cache_eviction(self):
+        backend = tmdb.MemoryCacheBackend(max_size=2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual(backend.get('a'), (True, 1))
+        self.assertEqual(backend.get('b'), (False, None))
+        backend.set('d', 4, 0)
+        self.assertEqual(backend.get('d'), (False, None))
+
+
+class TMDbClientTestCase(TestCase):
+    def create_client(self, base_url: str, **kwargs) -> tmdb.TMDbClient:
+        self.sleeps = []
+        return tmdb.TMDbClient('key', base_url, sleep=self.sleeps.append, **kwargs)
+
+    def test_retries_server_errors(self):
+        with StubTMDbServer([(503, {}, {}, 0), (502, {}, {}, 0), (200, {}, {'genres': []}, 0)]) as server:
+            client = self.create_client(server.base_url, max_retries=2, backoff_factor=1)
+            self.assertEqual(client.get('genre/movie/list'), {'genres': []})
+        self.assertEqual(server.request_count, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(0 <= self.sleeps[0] <= 1 and 0 <= self.sleeps[1] <= 2)
+
+    def test_respects_retry_after(self):
+        with StubTMDbServer([(429, {'Retry-After': '7'}, {}, 0), (200, {}, {'genres': []}, 0)]) as server:
+            client = self.create_client(server.base_url)
+            self.assertEqual(client.get('genre/movie/list'), {'genres': []})
+        self.assertEqual(self.sleeps, [7.0])
+
+    def test_times_out(self):
+        with StubTMDbServer([(200, {}, {}, 1), (200, {}, {}, 1)]) as server:
+            client = self.create_client(server.base_url, read_timeout=0.1, max_retries=1)
+            with self.assertRaises(tmdb.TMDbError):
+                client.get('genre/movie/list')
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_circuit_breaker(self):
+        with StubTMDbServer([(500, {}, {}, 0)] * 2 + [(200, {}, {'genres': []}, 0)]) as server:
+            client = self.create_client(server.base_url, max_retries=0, failure_threshold=2, cooldown=60)
+            for _ in range(2):
+                with self.assertRaises(tmdb.TMDbError):
+                    client.get('genre/movie/list')
+            # fails fast without hitting the server
+            with self.assertRaises(tmdb.TMDbUnavailableError):
+                client.get('genre/movie/list')
+            self.assertEqual(server.request_count, 2)
+            client.circuit_breaker.opened_at -= 60
+            self.assertEqual(client.get('genre/movie/list'), {'genres': []})
+            self.assertFalse(client.circuit_breaker.is_open)
+
+
+class AsyncTMDbClientTestCase(TestCase):
+    def create_client(self, base_url: str, **kwargs) -> tmdb.AsyncTMDbClient:
+        self.sleeps = []
+
+        async def sleep(delay: float):
+            self.sleeps.append(delay)
+
+        return tmdb.AsyncTMDbClient('key', base_url, sleep=sleep, **kwargs)
+
+    def get(self, client: tmdb.AsyncTMDbClient, path: str) -> dict:
+        async def get_and_close() -> dict:
+            try:
+                return await client.get(path)
+            finally:
+                await client.close()
+
+        return async_to_sync(get_and_close)()
+
+    def test_retries_server_errors(self):
+        with StubTMDbServer([
+                (503, {}, {}, 0), (429, {'Retry-After': '7'}, {}, 0), (200, {}, {'genres': []}, 0)
+        ]) as server:
+            client = self.create_client(server.base_url, max_retries=2, backoff_factor=1)
+            self.assertEqual(self.get(client, 'genre/movie/list'), {'genres': []})
+        self.assertEqual(server.request_count, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(0 <= self.sleeps[0] <= 1)
+        self.assertEqual(self.sleeps[1], 7.0)
+
+    def test_not_found(self):
+        with StubTMDbServer([(404, {}, {}, 0)]) as server:
+            client = self.create_client(server.base_url)
+            with self.assertRaises(tmdb.TMDbNotFoundError):
+                self.get(client, 'movie/0')
+        self.assertEqual(self.sleeps, [])
+
+    def test_times_out(self):
+        with StubTMDbServer([(200, {}, {}, 1), (200, {}, {}, 1)]) as server:
+            client = self.create_client(server.base_url, read_timeout=0.1, max_retries=1)
+            with self.assertRaises(tmdb.TMDbError):
+                self.get(client, 'genre/movie/list')
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_searches_with_the_async_client_over_asgi(self):
+        client = mock.Mock(get=mock.AsyncMock(return_value={'results': [{'id': 1, 'title': 'Up'}]}))
+        with override_settings(TMDB_CLIENT={**settings.TMDB_CLIENT, 'ASYNC': True}):
+            with mock.patch('api.tmdb.get_async_client', return_value=client), \
+                    mock.patch('api.tmdb.search_movie') as search_movie:
+                self.assertEqual(async_to_sync(tmdb.asearch_movie)('Up'), {'id': 1, 'title': 'Up'})
+        client.get.assert_awaited_once_with('search/movie', query='Up')
+        search_movie.assert_not_called()
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1)
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        for histogram in instrumentation.HISTOGRAMS.values():
+            histogram.clear()
+        create_movie(1)
+        Comment.objects.create(movie_id=1, text='Tremendous')
+
+    def test_server_timing(self):
+        with self.assertLogs('api.instrumentation', 'DEBUG') as logs:
+            response = self.client.get('/comments')
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="1 queries", tmdb;dur=0\.0;desc="0 calls", json;dur=[\d.]+$'
+        )
+        log_line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((log_line['view'], log_line['status'], log_line['db_queries']), ('comments', 200, 1))
+
+    def test_metrics(self):
+        self.client.get('/comments')
+        self.client.get('/comments')
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('movieproxy_request_duration_seconds_count{view="comments",method="GET",status="200"} 2', metrics)
+        self.assertIn('movieproxy_db_queries_bucket{view="comments",le="0"} 0', metrics)
+        self.assertIn('movieproxy_db_queries_bucket{view="comments",le="1"} 2', metrics)
+        self.assertIn('movieproxy_tmdb_calls_count{view="comments"} 2', metrics)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_unsampled(self):
+        response = self.client.get('/comments')
+        self.assertNotIn('Server-Timing', response)
+        metrics = instrumentation.render_metrics()
+        self.assertIn('movieproxy_request_duration_seconds_count{view="comments",method="GET",status="200"} 1', metrics)
+        self.assertNotIn('movieproxy_db_queries_count{view="comments"}', metrics)
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """Reads from replicas which are copies of the test database, each with a comment text of its own."""
+    replicas = ('replica_a', 'replica_b', 'replica_down')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        for alias in cls.replicas:
+            name = os.path.join(cls.directory.name, 'missing' if alias == 'replica_down' else '', f'{alias}.sqlite3')
+            # mirrors, so that they aren't flushed
+            default = connections['default'].settings_dict
+            connections.settings[alias] = {**default, 'NAME': name, 'TEST': {**default['TEST'], 'MIRROR': 'default'}}
+        cls.databases = {'default', *cls.replicas}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.replicas:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        create_movie(1)
+        Comment.objects.create(movie_id=1, text='Primary')
+        connection.ensure_connection()
+        for alias in ('replica_a', 'replica_b'):
+            replica = sqlite3.connect(connections[alias].settings_dict['NAME'])
+            connection.connection.backup(replica)
+            replica.close()
+            Comment.objects.using(alias).update(text=alias)
+        routing.reset_selector()
+
+    def tearDown(self):
+        routing.reset_selector()
+
+    def get_comment_text(self) -> str:
+        return self.client.get('/comments').json()[0]['text']
+
+    @override_settings(DATABASE_REPLICAS=['replica_a', 'replica_b'])
+    def test_round_robin(self):
+        self.assertEqual(
+            sorted(self.get_comment_text() for _ in range(4)), ['replica_a', 'replica_a', 'replica_b', 'replica_b']
+        )
+
+    @override_settings(DATABASE_REPLICAS=['replica_a'], READ_YOUR_WRITES_WINDOW=60)
+    def test_read_your_writes(self):
+        self.assertEqual(self.get_comment_text(), 'replica_a')
+        response = self.client.post('/comments', {'movie_id': '1', 'text': 'Tremendous'})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(routing.STICKY_COOKIE, response.cookies)
+        self.assertEqual(
+            sorted(comment['text'] for comment in self.client.get('/comments').json()), ['Primary', 'Tremendous']
+        )
+        self.client.cookies.pop(routing.STICKY_COOKIE)
+        self.assertEqual(self.get_comment_text(), 'replica_a')
+
+    @override_settings(
+        DATABASE_REPLICAS=['replica_a'], READ_YOUR_WRITES_WINDOW=60,
+        CACHES={**settings.CACHES, caching.CACHE_ALIAS: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-replica-responses'
+        }}
+    )
+    def test_lagging_replica_not_cached(self):
+        response = self.client.post('/comments', {'movie_id': '1', 'text': 'Tremendous'})
+        sticky_cookie = response.cookies[routing.STICKY_COOKIE]
+        # another client reads from the replica, which hasn't caught up with the comment
+        self.client.cookies.pop(routing.STICKY_COOKIE)
+        self.assertEqual(self.get_comment_text(), 'replica_a')
+        self.client.cookies[routing.STICKY_COOKIE] = sticky_cookie.value
+        self.assertEqual(
+            sorted(comment['text'] for comment in self.client.get('/comments').json()), ['Primary', 'Tremendous']
+        )
+
+    @override_settings(DATABASE_REPLICAS=['replica_down', 'replica_a'])
+    def test_failover(self):
+        self.assertEqual([self.get_comment_text() for _ in range(3)], ['replica_a', 'replica_a', 'replica_a'])
+        self.assertFalse(routing.get_selector().is_up('replica_down'))
+
+    @override_settings(DATABASE_REPLICAS=['replica_down'])
+    def test_failover_to_primary(self):
+        self.assertEqual(self.get_comment_text(), 'Primary')
+        self.assertEqual(self.get_comment_text(), 'Primary')
+
+    def test_least_latency(self):
+        now = [0.0]
+        selector = routing.ReplicaSelector(['a', 'b'], 'least_latency', retry_interval=10, clock=lambda: now[0])
+        selector.observe('a', 0.05)
+        selector.observe('b', 0.01)
+        self.assertEqual(selector.select(), 'b')
+        selector.mark_down('b')
+        self.assertEqual(selector.select(), 'a')
+        selector.mark_down('a')
+        self.assertEqual(selector.select(), 'default')
+        now[0] = 10
+        self.assertEqual(selector.select(), 'b')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'the SQLite profile only applies to SQLite')
+class SQLiteProfileTestCase(TestCase):
+    def test_pragmas_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            synchronous, = cursor.fetchone()
+            cursor.execute('PRAGMA busy_timeout')
+            busy_timeout, = cursor.fetchone()
+        if settings.SQLITE_PRAGMAS:
+            # 1 is NORMAL
+            self.assertEqual((synchronous, busy_timeout), (1, settings.SQLITE_PRAGMAS['busy_timeout']))
+
+    def test_read_only_connection(self):
+        pragmas = {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 5000}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            writer = sqlite3.connect(path)
+            for statement in sqlite.get_pragma_statements(pragmas):
+                writer.execute(statement)
+            writer.execute('CREATE TABLE note (text TEXT)')
+            writer.commit()
+            # in autocommit mode, so that transactions are only started explicitly
+            reader = sqlite3.connect(path, isolation_level=None)
+            statements = sqlite.get_pragma_statements(pragmas, read_only=True)
+            self.assertNotIn('PRAGMA journal_mode = wal', statements)
+            for statement in statements:
+                reader.execute(statement)
+            self.assertEqual(reader.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("INSERT INTO note VALUES ('Tremendous')")
+            # readers don't block the writer
+            reader.execute('BEGIN')
+            reader.execute('SELECT * FROM note').fetchall()
+            writer.execute("INSERT INTO note VALUES ('Tremendous')")
+            writer.commit()
+            reader.close()
+            writer.close()
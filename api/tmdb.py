@@ -1,26 +1,615 @@
-import os
-from typing import Optional, List
+import asyncio
+import concurrent.futures
+import datetime as dt
+import email.utils
+import hashlib
+import random
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, List, Tuple
+import httpx
 import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from api import instrumentation
 
-API_KEY = os.environ['TMDB_API_KEY']
 API_BASE_URL = 'https://api.themoviedb.org/3'
 HEADERS = { 'User-Agent': 'MovieProxy' }
 
 
+class TMDbError(Exception):
+    """TMDb could not be reached or responded with an error."""
+
+
+class TMDbNotFoundError(TMDbError):
+    """The requested TMDb resource does not exist."""
+
+
+class TMDbUnavailableError(TMDbError):
+    """TMDb has been failing, so requests fail fast until the circuit breaker cools down."""
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures, then lets a single trial request through after cooldown."""
+
+    def __init__(self, failure_threshold: int, cooldown: float, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.cooldown:
+                # half-open: let this request through as a trial and keep failing fast for the others
+                self.opened_at = self.clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+class RateLimiter:
+    """Token bucket allowing rate requests per second on average, in bursts of up to burst requests."""
+
+    def __init__(
+            self, rate: float, burst: int = 1, clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], None] = time.sleep
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning how many seconds to wait before the request may be made."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate) - 1
+            self.updated_at = now
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Block until a request may be made."""
+        delay = self.reserve()
+        if delay:
+            self.sleep(delay)
+
+
+class TMDbClient:
+    """TMDb API client with a pooled keep-alive session, timeouts, retries with backoff and a circuit breaker.
+
+    Rate limited (429) requests are retried after the Retry-After delay, while server errors, connection errors
+    and timeouts are retried with exponential backoff and full jitter. Only the latter count as circuit breaker
+    failures, as a rate limited TMDb is still up.
+    """
+
+    def __init__(
+            self, api_key: str, base_url: str = API_BASE_URL, *, pool_size: int = 10, connect_timeout: float = 3.05,
+            read_timeout: float = 10, max_retries: int = 3, backoff_factor: float = 0.5, max_backoff: float = 30,
+            failure_threshold: int = 5, cooldown: float = 30, rate_limit: float = 0,
+            sleep: Callable[[float], None] = time.sleep
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.circuit_breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.rate_limiter = RateLimiter(rate_limit, burst=max(1, int(rate_limit))) if rate_limit else None
+        self.session = self.create_session(pool_size)
+
+    def create_session(self, pool_size: int) -> requests.Session:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def get_retry_after(self, response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    return min(self.max_backoff, max(0.0, (retry_at - timezone.now()).total_seconds()))
+        return self.get_backoff(attempt)
+
+    def check_circuit_breaker(self):
+        if not self.circuit_breaker.allow_request():
+            raise TMDbUnavailableError('TMDb is unavailable')
+
+    def handle_request_error(self, error: Exception, attempt: int) -> Tuple[TMDbError, float, bool]:
+        return TMDbError(f'TMDb request failed: {error}'), self.get_backoff(attempt), True
+
+    def handle_response(self, response, path: str, attempt: int) -> Tuple[Optional[TMDbError], float, bool]:
+        """Check a TMDb response, raising errors which are not worth retrying.
+
+        Returns the error to retry, the delay before retrying and whether the error counts as a circuit breaker
+        failure, with no error if the response is successful.
+        """
+        if response.status_code == 429:
+            return TMDbError('TMDb rate limit exceeded'), self.get_retry_after(response, attempt), False
+        if response.status_code >= 500:
+            return TMDbError(f'TMDb responded with status {response.status_code}'), self.get_backoff(attempt), True
+        self.circuit_breaker.record_success()
+        if response.status_code == 404:
+            raise TMDbNotFoundError(f'TMDb resource {path} does not exist')
+        if response.status_code >= 400:
+            raise TMDbError(f'TMDb responded with status {response.status_code}')
+        return None, 0.0, False
+
+    def get(self, path: str, **params) -> dict:
+        """GET a TMDb API path, returning the decoded JSON response."""
+        self.check_circuit_breaker()
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(
+                    f'{self.base_url}/{path}', params={'api_key': self.api_key, **params}, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                instrumentation.record('tmdb', time.perf_counter() - start)
+                error, delay, is_failure = self.handle_request_error(e, attempt)
+            else:
+                instrumentation.record('tmdb', time.perf_counter() - start)
+                error, delay, is_failure = self.handle_response(response, path, attempt)
+                if error is None:
+                    return response.json()
+            if attempt < self.max_retries:
+                self.sleep(delay)
+        if is_failure:
+            self.circuit_breaker.record_failure()
+        raise error
+
+
+class AsyncTMDbClient(TMDbClient):
+    """Asynchronous TMDb API client, keeping many requests in flight from a single thread.
+
+    Uses an httpx connection pool, with the same timeouts, retries, circuit breaker and rate limit as TMDbClient.
+    Its connections are bound to the event loop they were opened in.
+    """
+
+    def __init__(self, *args, sleep: Callable[[float], Awaitable] = asyncio.sleep, **kwargs):
+        super().__init__(*args, sleep=sleep, **kwargs)
+
+    def create_session(self, pool_size: int) -> httpx.AsyncClient:
+        connect_timeout, read_timeout = self.timeout
+        return httpx.AsyncClient(
+            headers=HEADERS, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            # requests beyond the pool size queue up for a connection instead of failing
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None)
+        )
+
+    async def get(self, path: str, **params) -> dict:
+        """GET a TMDb API path, returning the decoded JSON response."""
+        self.check_circuit_breaker()
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                delay = self.rate_limiter.reserve()
+                if delay:
+                    await self.sleep(delay)
+            start = time.perf_counter()
+            try:
+                response = await self.session.get(
+                    f'{self.base_url}/{path}', params={'api_key': self.api_key, **params}
+                )
+            except httpx.TransportError as e:
+                instrumentation.record('tmdb', time.perf_counter() - start)
+                error, delay, is_failure = self.handle_request_error(e, attempt)
+            else:
+                instrumentation.record('tmdb', time.perf_counter() - start)
+                error, delay, is_failure = self.handle_response(response, path, attempt)
+                if error is None:
+                    return response.json()
+            if attempt < self.max_retries:
+                await self.sleep(delay)
+        if is_failure:
+            self.circuit_breaker.record_failure()
+        raise error
+
+    async def close(self):
+        await self.session.aclose()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single in-flight call, whose result they all share.
+
+    Callers may be in any thread or event loop, so that calls are coalesced across requests however they are served.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """Get the in-flight call with the key and whether it is new, so that the caller has to make it."""
+        with self._lock:
+            call = self.calls.get(key)
+            if call is not None:
+                return call, False
+            call = self.calls[key] = concurrent.futures.Future()
+            return call, True
+
+    def finish(self, key: str, call: concurrent.futures.Future, function: Callable[[], Any]):
+        with self._lock:
+            del self.calls[key]
+        try:
+            call.set_result(function())
+        except BaseException as e:
+            call.set_exception(e)
+
+    def do(self, key: str, function: Callable[[], Any]) -> Any:
+        call, is_new = self.join(key)
+        if is_new:
+            self.finish(key, call, function)
+        return call.result()
+
+    async def ado(self, key: str, function: Callable[[], Awaitable]) -> Any:
+        call, is_new = self.join(key)
+        if is_new:
+            task = asyncio.ensure_future(function())
+            task.add_done_callback(lambda _: self.finish(key, call, task.result))
+        # shielded, so that one caller going away doesn't cancel the call for everyone else
+        return await asyncio.shield(asyncio.wrap_future(call))
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache, bounded to max_size entries."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            try:
+                value, expires_at = self._entries[key]
+            except KeyError:
+                return False, None
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: Any, ttl: int):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def hash_key(key: str) -> str:
+    """Hash a cache key, as titles may be arbitrarily long or contain characters which some caches don't allow."""
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+class DjangoCacheBackend:
+    """Cache in one of the caches configured in Django's CACHES setting, which handles eviction itself."""
+
+    def __init__(self, alias: str = 'default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    @staticmethod
+    def get_cache_key(key: str) -> str:
+        return f'tmdb:{hash_key(key)}'
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        entry = self.cache.get(self.get_cache_key(key))
+        return (True, entry[0]) if entry is not None else (False, None)
+
+    def set(self, key: str, value: Any, ttl: int):
+        # wrap the value so that cached None (no results) can be told apart from a miss
+        self.cache.set(self.get_cache_key(key), (value,), ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class DatabaseCacheBackend:
+    """Cache in the TMDbCacheEntry table, so that entries survive restarts.
+
+    Beyond max_size entries, the ones closest to expiring are evicted.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+    @property
+    def model(self):
+        from api.models import TMDbCacheEntry
+        return TMDbCacheEntry
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        values = self.model.objects.filter(
+            key=hash_key(key), expires_at__gt=timezone.now()
+        ).values_list('value', flat=True)
+        for value in values:
+            return True, value
+        return False, None
+
+    def set(self, key: str, value: Any, ttl: int):
+        self.model.objects.update_or_create(
+            key=hash_key(key),
+            defaults={'query': key, 'value': value, 'expires_at': timezone.now() + dt.timedelta(seconds=ttl)}
+        )
+        excess_entry_count = self.model.objects.count() - self.max_size
+        if excess_entry_count > 0:
+            self.model.objects.filter(
+                key__in=self.model.objects.order_by('expires_at').values_list('key', flat=True)[:excess_entry_count]
+            ).delete()
+
+    def clear(self):
+        self.model.objects.all().delete()
+
+
+class TMDbCache:
+    """Cache of TMDb lookups, including negative ("no results") ones, with hit and miss counters."""
+
+    def __init__(self, backend, ttl: int, negative_ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        found, value = self.backend.get(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value
+
+    def set(self, key: str, value: Any):
+        self.backend.set(key, value, self.ttl if value is not None else self.negative_ttl)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[TMDbCache]:
+    """Get the TMDb cache configured in the TMDB_CACHE setting, or None if caching is disabled."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = settings.TMDB_CACHE
+                if config['BACKEND'] == 'memory':
+                    backend = MemoryCacheBackend(config['MAX_SIZE'])
+                elif config['BACKEND'] == 'django':
+                    backend = DjangoCacheBackend(config.get('ALIAS', 'default'))
+                elif config['BACKEND'] == 'database':
+                    backend = DatabaseCacheBackend(config['MAX_SIZE'])
+                elif config['BACKEND'] == 'none':
+                    return None
+                else:
+                    raise ValueError(f'unknown TMDb cache backend {config["BACKEND"]!r}')
+                _cache = TMDbCache(backend, config['TTL'], config['NEGATIVE_TTL'])
+    return _cache
+
+
+def reset_cache():
+    """Drop the configured TMDb cache, so that it gets rebuilt from settings on next use."""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def get_api_key() -> str:
+    """Get the TMDb API key, read on first TMDb call rather than on import, so that TMDb isn't needed to start."""
+    api_key = settings.TMDB_CLIENT['API_KEY']
+    if not api_key:
+        raise ImproperlyConfigured('TMDB_API_KEY must be set to call TMDb')
+    return api_key
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> TMDbClient:
+    """Get the shared TMDb client configured in the TMDB_CLIENT setting."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = settings.TMDB_CLIENT
+                _client = TMDbClient(
+                    get_api_key(), config['BASE_URL'], pool_size=config['POOL_SIZE'],
+                    connect_timeout=config['CONNECT_TIMEOUT'], read_timeout=config['READ_TIMEOUT'],
+                    max_retries=config['MAX_RETRIES'], backoff_factor=config['BACKOFF_FACTOR'],
+                    max_backoff=config['MAX_BACKOFF'], failure_threshold=config['CIRCUIT_BREAKER_THRESHOLD'],
+                    cooldown=config['CIRCUIT_BREAKER_COOLDOWN'], rate_limit=config['RATE_LIMIT']
+                )
+    return _client
+
+
+def reset_client():
+    """Drop the shared TMDb client, so that it gets rebuilt from settings on next use."""
+    global _client
+    with _client_lock:
+        _client = None
+        _async_clients.clear()
+
+
+_executor = None
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Get the threads making calls with the shared TMDb client for async code, one per pooled connection."""
+    global _executor
+    if _executor is None:
+        with _client_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    settings.TMDB_CLIENT['POOL_SIZE'], thread_name_prefix='tmdb'
+                )
+    return _executor
+
+
+# async clients are bound to an event loop, so there is one per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncTMDbClient:
+    """Get the async TMDb client of the running event loop, configured in the TMDB_CLIENT setting.
+
+    It shares its circuit breaker and rate limit with the shared TMDb client, so that they apply to the whole process.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        config = settings.TMDB_CLIENT
+        client = AsyncTMDbClient(
+            get_api_key(), config['BASE_URL'], pool_size=config['ASYNC_POOL_SIZE'],
+            connect_timeout=config['CONNECT_TIMEOUT'], read_timeout=config['READ_TIMEOUT'],
+            max_retries=config['MAX_RETRIES'], backoff_factor=config['BACKOFF_FACTOR'],
+            max_backoff=config['MAX_BACKOFF']
+        )
+        client.circuit_breaker = get_client().circuit_breaker
+        client.rate_limiter = get_client().rate_limiter
+        _async_clients[loop] = client
+    return _async_clients[loop]
+
+
+# in-flight lookups of the whole process
+_single_flight = SingleFlight()
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query, so that trivially different queries share a cache entry."""
+    return ' '.join(query.casefold().split())
+
+
+def search_movie(title: str) -> Optional[dict]:
+    """Search TMDb for the movie with the the closest matching title (if one exists)."""
+    response = get_client().get('search/movie', query=title)
+    if response['results']:
+        return response['results'][0]
+    else:
+        return None
+
+
 def fetch_movie(title: str) -> Optional[dict]:
-    """Fetch the movie with the the closest matching title (if one exists)."""
-    params = {'api_key': API_KEY, 'query': title}
-    response = requests.get(
-        f'{API_BASE_URL}/search/movie', headers=HEADERS, params=params
-    ).json()
+    """Fetch the movie with the the closest matching title (if one exists), going through the cache.
+
+    Concurrent fetches of the same title share a single TMDb request.
+    """
+    cache = get_cache()
+    key = f'search/movie:{normalize_query(title)}'
+
+    def fetch_uncached_movie() -> Optional[dict]:
+        if cache is None:
+            return search_movie(title)
+        found, movie = cache.get(key)
+        if not found:
+            movie = search_movie(title)
+            cache.set(key, movie)
+        return movie
+
+    return _single_flight.do(key, fetch_uncached_movie)
+
+
+async def asearch_movie(title: str) -> Optional[dict]:
+    """Search TMDb for the movie with the the closest matching title (if one exists), without blocking."""
+    if not settings.TMDB_CLIENT['ASYNC']:
+        # an async client would only live as long as the loop of the request, without keep-alive connections
+        return await sync_to_async(search_movie, thread_sensitive=False, executor=get_executor())(title)
+    response = await get_async_client().get('search/movie', query=title)
     if response['results']:
         return response['results'][0]
     else:
         return None
 
 
+async def afetch_movie(title: str) -> Optional[dict]:
+    """Fetch the movie with the the closest matching title (if one exists), going through the cache.
+
+    Concurrent fetches of the same title share a single TMDb request.
+    """
+    cache = get_cache()
+    key = f'search/movie:{normalize_query(title)}'
+
+    async def fetch_uncached_movie() -> Optional[dict]:
+        if cache is None:
+            return await asearch_movie(title)
+        found, movie = await sync_to_async(cache.get)(key)
+        if not found:
+            movie = await asearch_movie(title)
+            await sync_to_async(cache.set)(key, movie)
+        return movie
+
+    return await _single_flight.ado(key, fetch_uncached_movie)
+
+
+def fetch_movie_details(movie_id: int) -> dict:
+    """Fetch up-to-date details of the movie with the given ID, bypassing the cache."""
+    return get_client().get(f'movie/{movie_id}')
+
+
 def fetch_genres() -> List[dict]:
     """Fetch all genres."""
-    params = {'api_key': API_KEY}
-    response = requests.get(f'{API_BASE_URL}/genre/movie/list', headers=HEADERS, params=params).json()
+    response = get_client().get('genre/movie/list')
     return response['genres']
@@ -1,8 +1,17 @@
-from typing import Sequence
+import asyncio
+from typing import AsyncIterator, Iterator, Optional, Sequence
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
 from django.db.utils import IntegrityError
-from api.models import Movie, Comment
+from api import caching, ingestion, instrumentation, pagination, search, serialization, tmdb
+from api.instrumentation import JsonResponse
+from api.models import InvalidMovieError, Movie, Comment
+
+STREAM_CHUNK_SIZE = 500
+BULK_MAX_TITLES = 1000
 
 
 def generate_resource_not_found_response(resource_type: str) -> JsonResponse:
@@ -44,76 +53,258 @@ def generate_invalid_field_value_response(
     )
 
 
+def generate_service_unavailable_response(service: str) -> JsonResponse:
+    """Generate a 503 error response."""
+    return JsonResponse(
+        { 'error': f'{service} is currently unavailable, please try again later' },
+        status=503
+    )
+
+
+def generate_json_response(data, status: int = 200) -> HttpResponse:
+    """Generate a JSON response, encoded with the fast JSON backend."""
+    return HttpResponse(serialization.encode_json(data), content_type='application/json', status=status)
+
+
+def generate_page_response(request, queryset, order_by: Sequence[str]) -> HttpResponse:
+    """Generate a 200 response with a page of objects and the cursor of the next page or a 422 error response."""
+    limit = pagination.DEFAULT_LIMIT
+    if request.GET.get('limit'):
+        try:
+            limit = int(request.GET['limit'])
+        except ValueError:
+            return generate_invalid_field_value_response('limit', request.GET['limit'], 'must be an integer')
+        if not 1 <= limit <= pagination.MAX_LIMIT:
+            return generate_invalid_field_value_response(
+                'limit', request.GET['limit'], f'must be between 1 and {pagination.MAX_LIMIT}'
+            )
+    fields, serialize_rows = serialization.get_row_serializer(queryset)
+    try:
+        page, next_cursor = pagination.paginate(queryset, order_by, limit, request.GET.get('cursor'), fields)
+    except pagination.InvalidCursorError as e:
+        return generate_invalid_field_value_response('cursor', request.GET['cursor'], str(e))
+    return generate_json_response({'results': serialize_rows(page, queryset.db), 'next': next_cursor})
+
+
+def get_stream_format(request) -> Optional[str]:
+    """Determine whether the client asked for a streamed response and in which format."""
+    if 'application/x-ndjson' in request.META.get('HTTP_ACCEPT', '') or request.GET.get('stream') == 'ndjson':
+        return 'ndjson'
+    if request.GET.get('stream') in ('1', 'true'):
+        return 'json'
+    return None
+
+
+async def iterate_off_event_loop(iterator: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """Iterate over a sync iterator (which may query the database) one item at a time off the event loop."""
+    done = object()
+    try:
+        while True:
+            item = await sync_to_async(next)(iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        await sync_to_async(iterator.close)()
+
+
+def generate_streaming_response(request, queryset, stream_format: str) -> StreamingHttpResponse:
+    """Generate a 200 response streaming objects as a JSON array or as NDJSON, fetching them in chunks.
+
+    Over ASGI the content is an async iterator, as Django would read a sync one whole into memory before sending it.
+    """
+    json_backend = serialization.get_json_backend()
+
+    def stream_chunks():
+        for chunk in serialization.serialize_chunks(queryset, STREAM_CHUNK_SIZE):
+            yield [json_backend.dumps(obj) for obj in chunk]
+
+    def stream_json_array():
+        # join elements exactly like the JSON backend does, so the output is the same as when not streamed
+        yield b'['
+        for index, chunk in enumerate(stream_chunks()):
+            yield (json_backend.item_separator if index else b'') + json_backend.item_separator.join(chunk)
+        yield b']'
+
+    def stream_ndjson():
+        for chunk in stream_chunks():
+            yield b''.join(line + b'\n' for line in chunk)
+
+    content = stream_ndjson() if stream_format == 'ndjson' else stream_json_array()
+    if isinstance(request, ASGIRequest):
+        content = iterate_off_event_loop(content)
+    return StreamingHttpResponse(
+        content, content_type='application/x-ndjson' if stream_format == 'ndjson' else 'application/json'
+    )
+
+
 def welcome(request) -> HttpResponse:
     return HttpResponse("Welcome to MovieProxy")
 
 
-def movies(request) -> JsonResponse:
-    if request.method == 'POST':
-        # check if required field is present
-        if not request.POST.get('title'):
-            return generate_mandatory_field_missing_response('title')
+def health(request) -> JsonResponse:
+    # deliberately doesn't touch the database, so that it only reflects whether this process can serve requests
+    return JsonResponse({'status': 'ok'})
+
+
+def metrics(request) -> HttpResponse:
+    # metrics of this process only, each worker process is scraped separately
+    return HttpResponse(instrumentation.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def list_movies(request) -> HttpResponse:
+    movies = Movie.objects.all()
+    # optionally filter, ordering by relevance
+    if request.GET.get('title'):
+        search_mode = request.GET.get('search_mode') or 'substring'
+        if search_mode not in search.SEARCH_MODES:
+            return generate_invalid_field_value_response(
+                'search_mode', search_mode, f'must be one of: {", ".join(search.SEARCH_MODES)}'
+            )
+        movies = search.search_movies(movies, request.GET['title'], search_mode)
+    # optionally order, search results being ordered (and paginated) by relevance unless ordered otherwise
+    order_by_fields = list(movies.query.order_by)
+    if request.GET.get('order_by'):
+        order_by_fields = [field.strip() for field in request.GET['order_by'].strip(',').split(',')]
+        for field in order_by_fields:
+            if field not in Movie.SORTABLE_FIELDS:
+                return generate_invalid_field_value_response(
+                    'order_by', field, 'not a sortable movie field'
+                )
+        if order_by_fields:
+            movies = movies.order_by(*order_by_fields)
+    # optionally paginate
+    if request.GET.get('limit') or request.GET.get('cursor'):
+        return generate_page_response(request, movies, order_by_fields)
+    # optionally stream
+    stream_format = get_stream_format(request)
+    if stream_format:
+        return generate_streaming_response(request, movies, stream_format)
+    return generate_json_response(serialization.serialize(movies))
+
+
+def list_comments(request) -> HttpResponse:
+    comments = Comment.objects.all()
+    # optionally filter
+    if request.GET.get('movie_id'):
         try:
-            movie, created = Movie.objects.update_or_create_from_tmdb(request.POST['title'])
+            comments = comments.filter(movie_id=request.GET['movie_id'])
         except ValueError:
-            return generate_resource_not_found_response('movie')
-        else:
-            return JsonResponse(movie.to_dict(), status=201 if created else 200)
+            return generate_invalid_field_value_response('movie_id', request.GET['movie_id'])
+    # optionally paginate
+    if request.GET.get('limit') or request.GET.get('cursor'):
+        return generate_page_response(request, comments, ('created_at', 'id'))
+    # optionally stream
+    stream_format = get_stream_format(request)
+    if stream_format:
+        return generate_streaming_response(request, comments, stream_format)
+    return generate_json_response(serialization.serialize(comments))
+
+
+# The views are sync, so that threaded workers serve reads without starting an event loop per request. Writes
+# waiting on TMDb or on a group commit are async, so that over ASGI they wait on the server's event loop, with
+# database work run off it with sync_to_async.
+
+async def add_movie(request) -> JsonResponse:
+    # check if required field is present
+    if not request.POST.get('title'):
+        return generate_mandatory_field_missing_response('title')
+    try:
+        movie, created = await Movie.objects.aupdate_or_create_from_tmdb(request.POST['title'])
+    except ValueError:
+        return generate_resource_not_found_response('movie')
+    except InvalidMovieError:
+        return generate_invalid_field_value_response(
+            'title', request.POST['title'], 'the matching movie can\'t be stored'
+        )
+    except tmdb.TMDbError:
+        return generate_service_unavailable_response('TMDb')
+    else:
+        return JsonResponse(await sync_to_async(movie.to_dict)(), status=201 if created else 200)
+
+
+@caching.cache_response(caching.get_movies_scopes, skip_if=get_stream_format)
+def movies(request) -> JsonResponse:
+    if request.method == 'POST':
+        return async_to_sync(add_movie)(request)
 
     elif request.method == 'GET':
-        movies = Movie.objects.all()
-        # optionally filter
-        if request.GET.get('title'):
-            movies = (
-                movies.filter(title__icontains=request.GET['title']) |
-                movies.filter(original_title__icontains=request.GET['title'])
-            )
-        # optionally order
-        if request.GET.get('order_by'):
-            order_by_fields = [field.strip() for field in request.GET['order_by'].strip(',').split(',')]
-            for field in order_by_fields:
-                if field not in Movie.SORTABLE_FIELDS:
-                    return generate_invalid_field_value_response(
-                        'order_by', field, 'not a sortable movie field'
-                    )
-            if order_by_fields:
-                movies = movies.order_by(*order_by_fields)
-        return JsonResponse([movie.to_dict() for movie in movies], safe=False)
+        return list_movies(request)
 
     else:
         return generate_method_not_allowed_response(request.method, ('GET', 'POST'))
 
 
-def comments(request) -> JsonResponse:
+async def movies_bulk(request) -> JsonResponse:
     if request.method == 'POST':
-        # check if required fields are present
-        if not request.POST.get('movie_id'):
-            return generate_mandatory_field_missing_response('movie_id')
-        if not request.POST.get('text'):
-            return generate_mandatory_field_missing_response('text')
-        try:
-            comment = Comment.objects.create(movie_id=request.POST['movie_id'], text=request.POST['text'])
-        except IntegrityError:
+        # check if required field is present
+        titles = [title for title in request.POST.getlist('title') if title.strip()]
+        if not titles:
+            return generate_mandatory_field_missing_response('title')
+        if len(titles) > BULK_MAX_TITLES:
             return generate_invalid_field_value_response(
-                'movie_id', request.POST['movie_id'], 'movie not in database'
+                'title', f'{len(titles)} titles', f'at most {BULK_MAX_TITLES} titles are allowed per request'
             )
-        else:
-            return JsonResponse(comment.to_dict(), status=201)
+        return JsonResponse(await Movie.objects.abulk_update_or_create_from_tmdb(titles), safe=False)
+
+    else:
+        return generate_method_not_allowed_response(request.method, ('POST',))
+
+
+async def ingest_comment(movie_id: int, text: str) -> JsonResponse:
+    """Queue a comment for a group commit, responding once it is committed or right away, depending on the mode."""
+    ingester = ingestion.get_ingester()
+    if not await sync_to_async(lambda: movie_id in ingester.known_movie_ids)():
+        return generate_invalid_field_value_response('movie_id', str(movie_id), 'movie not in database')
+    try:
+        future = await sync_to_async(ingester.submit)(movie_id, text)
+    except (ingestion.QueueFullError, ingestion.IngesterStoppedError):
+        return generate_service_unavailable_response('Comment ingestion')
+    if settings.COMMENT_INGESTION['MODE'] == 'deferred':
+        # accepted, but not stored yet, so there is no ID or creation time to return
+        return JsonResponse({'movie_id': movie_id, 'text': text}, status=202)
+    try:
+        comment = await asyncio.wrap_future(future)
+    except IntegrityError:
+        return generate_invalid_field_value_response('movie_id', str(movie_id), 'movie not in database')
+    return JsonResponse(comment.to_dict(), status=201)
+
+
+async def add_comment(request) -> JsonResponse:
+    # check if required fields are present
+    if not request.POST.get('movie_id'):
+        return generate_mandatory_field_missing_response('movie_id')
+    if not request.POST.get('text'):
+        return generate_mandatory_field_missing_response('text')
+    try:
+        movie_id = int(request.POST['movie_id'])
+    except ValueError:
+        return generate_invalid_field_value_response('movie_id', request.POST['movie_id'], 'must be an integer')
+    if settings.COMMENT_INGESTION['MODE'] != 'direct':
+        return await ingest_comment(movie_id, request.POST['text'])
+    try:
+        comment = await Comment.objects.acreate(movie_id=movie_id, text=request.POST['text'])
+    except IntegrityError:
+        return generate_invalid_field_value_response(
+            'movie_id', request.POST['movie_id'], 'movie not in database'
+        )
+    else:
+        return JsonResponse(comment.to_dict(), status=201)
+
+
+@caching.cache_response(caching.get_comments_scopes, skip_if=get_stream_format)
+def comments(request) -> JsonResponse:
+    if request.method == 'POST':
+        return async_to_sync(add_comment)(request)
 
     elif request.method == 'GET':
-        comments = Comment.objects.all()
-        # optionally filter
-        if request.GET.get('movie_id'):
-            try:
-                comments = comments.filter(movie_id=request.GET['movie_id'])
-            except ValueError:
-                return generate_invalid_field_value_response('movie_id', request.GET['movie_id'])
-        return JsonResponse([comment.to_dict() for comment in comments], safe=False)
+        return list_comments(request)
 
     else:
         return generate_method_not_allowed_response(request.method, ('GET', 'POST'))
 
 
+@caching.cache_response(caching.get_top_scopes)
 def top(request) -> JsonResponse:
     if request.method == 'GET':
         # check if required fields are present
@@ -0,0 +1 @@
+"""Benchmarks of MovieProxy's hot paths and endpoints, run with `python3 -m benchmarks` (see README)."""
@@ -0,0 +1,143 @@
+"""Seed a throwaway database, run the microbenchmarks, the per-endpoint load scenarios and (on SQLite) the SQLite
+profile comparison, and report them as JSON.
+
+TMDb is replaced by a local fake server, so results don't depend on the network or on a TMDb API key.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+from benchmarks.fake_tmdb import FakeTMDbServer
+
+COMPARED_METRICS = (
+    'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'throughput_ops', 'queries_per_request', 'queries_per_call'
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks', description=__doc__)
+    parser.add_argument('--movies', type=int, default=1000, help='number of movies seeded')
+    parser.add_argument('--genres', type=int, default=19, help='number of genres seeded (at most 19)')
+    parser.add_argument('--comments', type=int, default=20000, help='number of comments seeded')
+    parser.add_argument('--days', type=int, default=365, help='number of past days the comments are spread over')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generated data')
+    parser.add_argument(
+        '--snapshot', help='catalogue snapshot (see export_catalog) to load instead of generating data'
+    )
+    parser.add_argument('--save-snapshot', help='file to save the benchmarked data to as a catalogue snapshot')
+    parser.add_argument('--iterations', type=int, default=50, help='calls per microbenchmark')
+    parser.add_argument('--requests', type=int, default=500, help='requests per load scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients per load scenario')
+    parser.add_argument('--tmdb-latency', type=float, default=0.05, help='seconds the fake TMDb takes to respond')
+    parser.add_argument(
+        '--url', help='load a running instance at this URL instead of serving the app locally (seed it yourself)'
+    )
+    parser.add_argument('--skip-micro', action='store_true', help='skip the microbenchmarks')
+    parser.add_argument('--skip-load', action='store_true', help='skip the load scenarios')
+    parser.add_argument(
+        '--sqlite-duration', type=float, default=5, help='seconds each SQLite profile is loaded for'
+    )
+    parser.add_argument('--sqlite-readers', type=int, default=8, help='reading threads per SQLite profile')
+    parser.add_argument('--sqlite-writers', type=int, default=2, help='writing threads per SQLite profile')
+    parser.add_argument('--skip-sqlite', action='store_true', help='skip the SQLite profile comparison')
+    parser.add_argument('--output', help='file to write the JSON results to, standard output by default')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    return parser.parse_args()
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, results: dict):
+    """Print the relative change of every compared metric present in both runs."""
+    for section in ('micro', 'load', 'sqlite'):
+        for name, metrics in results.get(section, {}).items():
+            baseline_metrics = baseline.get(section, {}).get(name, {})
+            for metric in COMPARED_METRICS:
+                old, new = baseline_metrics.get(metric), metrics.get(metric)
+                if old and new is not None:
+                    print(
+                        f'{section}.{name}.{metric}: {old:.2f} -> {new:.2f} ({(new - old) / old:+.1%})',
+                        file=sys.stderr
+                    )
+
+
+def main():
+    args = parse_args()
+    with FakeTMDbServer(latency=args.tmdb_latency) as fake_tmdb, tempfile.TemporaryDirectory() as temp_dir:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movieproxy.settings')
+        os.environ.setdefault('SECRET_KEY', 'benchmarks')
+        os.environ.setdefault('ALLOWED_HOSTS', '127.0.0.1,localhost')
+        os.environ.setdefault('TMDB_API_KEY', 'benchmarks')
+        os.environ['TMDB_API_BASE_URL'] = fake_tmdb.base_url
+        os.environ.setdefault('TMDB_RATE_LIMIT', '0')
+        import django
+        django.setup()
+        from django.db import connection
+        from django.test.utils import setup_databases, teardown_databases
+        from api import snapshots
+        from benchmarks import data, load, micro, sqlite
+
+        if connection.vendor == 'sqlite':
+            # a file rather than memory, so that the local server's threads share it
+            connection.settings_dict['TEST']['NAME'] = os.path.join(temp_dir, 'benchmarks.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            if args.snapshot:
+                with snapshots.open_snapshot(args.snapshot, 'r') as snapshot:
+                    seeded = snapshots.import_catalog(snapshot)
+                # the scenarios pick movies by ID from 1, as seeded, and so do snapshots saved here
+                args.movies = seeded['movies']
+            else:
+                seeded = data.seed(args.movies, args.genres, args.comments, args.days, args.seed)
+            if args.save_snapshot:
+                with snapshots.open_snapshot(args.save_snapshot, 'w') as snapshot:
+                    snapshots.export_catalog(snapshot, include_comments=True)
+            results = {
+                'meta': {
+                    'commit': get_commit(),
+                    'started_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'parameters': vars(args)
+                },
+                'data': seeded
+            }
+            if not args.skip_micro:
+                results['micro'] = micro.run(args.iterations)
+            if not args.skip_load:
+                results['load'] = load.run(args.url, args.movies, args.requests, args.concurrency)
+            if not args.skip_sqlite and connection.vendor == 'sqlite':
+                connection.ensure_connection()
+                results['sqlite'] = sqlite.run(
+                    connection.connection, temp_dir, args.movies, args.sqlite_duration, args.sqlite_readers,
+                    args.sqlite_writers
+                )
+            results['meta']['tmdb_requests'] = fake_tmdb.request_count
+        finally:
+            teardown_databases(old_config, verbosity=0)
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            compare(json.load(baseline_file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import datetime as dt
+import random
+from typing import Dict
+from django.db import transaction
+from api.models import Genre, Movie, Comment, CommentDailyCount
+from benchmarks.fake_tmdb import GENRES, generate_movie
+
+WORDS = [
+    'the', 'last', 'night', 'city', 'dark', 'love', 'war', 'story', 'king', 'star', 'house', 'blood', 'man', 'girl',
+    'secret', 'river', 'road', 'dream', 'fire', 'island', 'ghost', 'summer', 'winter', 'return', 'journey'
+]
+
+
+def generate_title(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def seed(
+        movie_count: int, genre_count: int, comment_count: int, days: int = 365, random_seed: int = 0,
+        batch_size: int = 1000
+) -> Dict[str, int]:
+    """Seed the database with movie_count movies of up to genre_count genres each (at most 19, those of TMDb) and
+    comment_count comments spread over the last days days, skewed towards a few popular movies.
+
+    The data is generated from random_seed, so that runs with the same parameters benchmark the same data.
+    """
+    rng = random.Random(random_seed)
+    genres = [Genre(id=genre['id'], name=genre['name']) for genre in GENRES[:genre_count]]
+    now = dt.datetime.now(dt.timezone.utc)
+    with transaction.atomic():
+        Genre.objects.bulk_create(genres, ignore_conflicts=True)
+        movies = []
+        for movie_id in range(1, movie_count + 1):
+            raw_movie = generate_movie(movie_id, generate_title(rng))
+            movies.append(Movie(fetched_at=now, **{field: raw_movie[field] for field in Movie.TMDB_FIELDS}))
+        Movie.objects.bulk_create(movies, batch_size=batch_size)
+        MovieGenre = Movie.genres.through
+        MovieGenre.objects.bulk_create([
+            MovieGenre(movie_id=movie.id, genre_id=genre.id)
+            for movie in movies for genre in rng.sample(genres, rng.randint(0, min(3, len(genres))))
+        ], batch_size=batch_size)
+        comments = []
+        for _ in range(comment_count):
+            # a Pareto distribution makes a few movies get most of the comments, like in reality
+            movie_id = min(movie_count, int(rng.paretovariate(1.2)))
+            comments.append(Comment(movie_id=movie_id, text=' '.join(rng.choices(WORDS, k=rng.randint(3, 30)))))
+        Comment.objects.bulk_create(comments, batch_size=batch_size)
+        # creation times are set on insert, so spread them out afterwards
+        for comment in comments:
+            comment.created_at = now - dt.timedelta(seconds=rng.uniform(0, days * 24 * 60 * 60))
+        Comment.objects.bulk_update(comments, ['created_at'], batch_size=batch_size)
+        daily_count_count = CommentDailyCount.objects.rebuild()
+    return {
+        'movies': movie_count, 'genres': len(genres), 'comments': comment_count,
+        'daily_comment_counts': daily_count_count
+    }
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+GENRES = [
+    {'id': 28, 'name': 'Action'}, {'id': 12, 'name': 'Adventure'}, {'id': 16, 'name': 'Animation'},
+    {'id': 35, 'name': 'Comedy'}, {'id': 80, 'name': 'Crime'}, {'id': 99, 'name': 'Documentary'},
+    {'id': 18, 'name': 'Drama'}, {'id': 10751, 'name': 'Family'}, {'id': 14, 'name': 'Fantasy'},
+    {'id': 36, 'name': 'History'}, {'id': 27, 'name': 'Horror'}, {'id': 10402, 'name': 'Music'},
+    {'id': 9648, 'name': 'Mystery'}, {'id': 10749, 'name': 'Romance'}, {'id': 878, 'name': 'Science Fiction'},
+    {'id': 10770, 'name': 'TV Movie'}, {'id': 53, 'name': 'Thriller'}, {'id': 10752, 'name': 'War'},
+    {'id': 37, 'name': 'Western'}
+]
+
+
+def generate_movie(movie_id: int, title: str) -> dict:
+    """Generate a TMDb movie, deterministically given its ID."""
+    return {
+        'id': movie_id,
+        'overview': f'The story of {title}.',
+        'release_date': f'{1950 + movie_id % 70}-{1 + movie_id % 12:02}-{1 + movie_id % 28:02}',
+        'genre_ids': [GENRES[movie_id % len(GENRES)]['id'], GENRES[movie_id // len(GENRES) % len(GENRES)]['id']],
+        'original_title': title,
+        'original_language': 'en',
+        'title': title,
+        'popularity': movie_id % 1000 / 10,
+        'vote_count': movie_id % 10000,
+        'vote_average': movie_id % 100 / 10
+    }
+
+
+def get_movie_id(title: str) -> int:
+    # high IDs, so that searched movies don't collide with seeded ones
+    return 10 ** 6 + int(hashlib.md5(title.casefold().encode()).hexdigest()[:6], 16)
+
+
+class FakeTMDbServer:
+    """Local HTTP server standing in for TMDb, answering searches with generated movies after latency seconds.
+
+    Searches for titles starting with "nonexistent" find nothing.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.request_count += 1
+                time.sleep(fake.latency)
+                url = urlsplit(self.path)
+                status, body = fake.respond(url.path, {key: values[0] for key, values in parse_qs(url.query).items()})
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/3'
+
+    def respond(self, path: str, params: Dict[str, str]) -> tuple:
+        if path == '/3/search/movie':
+            query = params.get('query', '')
+            results: List[dict] = []
+            if not query.casefold().startswith('nonexistent'):
+                results.append(generate_movie(get_movie_id(query), query.title()))
+            return 200, {'page': 1, 'results': results, 'total_results': len(results), 'total_pages': 1}
+        if path == '/3/genre/movie/list':
+            return 200, {'genres': GENRES}
+        if path.startswith('/3/movie/'):
+            try:
+                movie_id = int(path.rsplit('/', 1)[1])
+            except ValueError:
+                return 404, {'status_message': 'The resource you requested could not be found.'}
+            return 200, generate_movie(movie_id, f'Movie {movie_id}')
+        return 404, {'status_message': 'The resource you requested could not be found.'}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
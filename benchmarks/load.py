@@ -0,0 +1,136 @@
+import datetime as dt
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import requests
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db.backends.signals import connection_created
+from benchmarks.data import WORDS
+from benchmarks.stats import summarize_durations
+
+# a scenario builds the (method, path, form data) of its index-th request
+Scenario = Callable[[int], Tuple[str, str, Optional[dict]]]
+
+
+def get_scenarios(movie_count: int) -> Dict[str, Scenario]:
+    today = dt.date.today()
+    rng = random.Random(0)
+    return {
+        'health': lambda index: ('GET', '/health', None),
+        'get_movies_page': lambda index: ('GET', '/movies?order_by=-popularity&limit=100', None),
+        'get_movies_search': lambda index: ('GET', f'/movies?title={WORDS[index % len(WORDS)]}&limit=20', None),
+        'get_comments_movie': lambda index: ('GET', f'/comments?movie_id={1 + index % min(movie_count, 20)}', None),
+        'get_comments_page': lambda index: ('GET', '/comments?limit=100', None),
+        'get_top': lambda index: (
+            'GET', f'/top?start_date={today - dt.timedelta(days=30)}&end_date={today}&max_rank=10', None
+        ),
+        'post_movies': lambda index: ('POST', '/movies', {'title': f'load test title {index}'}),
+        'post_comments': lambda index: (
+            'POST', '/comments', {'movie_id': rng.randint(1, movie_count), 'text': 'Tremendous'}
+        )
+    }
+
+
+class QueryCounter:
+    """Counts the queries of all database connections opened from now on, in any thread."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        connection_created.connect(self.install, weak=False)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer:
+    """The app served over WSGI from a background thread of this process, which counts its queries."""
+
+    def __init__(self):
+        self.query_counter = QueryCounter()
+        self.server = ThreadedWSGIServer(('127.0.0.1', 0), QuietWSGIRequestHandler, allow_reuse_address=False)
+        self.server.set_app(get_wsgi_application())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def load(
+        url: str, scenario: Scenario, request_count: int, concurrency: int,
+        query_counter: Optional[QueryCounter] = None
+) -> Dict[str, float]:
+    """Make request_count requests of the scenario from concurrency clients, each with a keep-alive session."""
+    indices = itertools.count()
+    durations: List[float] = []
+    error_count = 0
+    lock = threading.Lock()
+
+    def run_client():
+        nonlocal error_count
+        session = requests.Session()
+        while True:
+            index = next(indices)
+            if index >= request_count:
+                return
+            method, path, data = scenario(index)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, f'{url}{path}', data=data, timeout=60)
+                is_error = response.status_code >= 400
+            except requests.RequestException:
+                is_error = True
+            duration = time.perf_counter() - start
+            with lock:
+                durations.append(duration)
+                error_count += is_error
+
+    query_count_before = query_counter.count if query_counter else 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for client in [executor.submit(run_client) for _ in range(concurrency)]:
+            client.result()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': request_count,
+        'errors': error_count,
+        'throughput_rps': request_count / elapsed,
+        'queries_per_request': (query_counter.count - query_count_before) / request_count if query_counter else None,
+        **summarize_durations(durations)
+    }
+
+
+def run(url: Optional[str], movie_count: int, request_count: int, concurrency: int) -> Dict[str, dict]:
+    """Load every endpoint in turn, serving the app locally unless the URL of a running instance is given.
+
+    Query counts are only known when serving locally.
+    """
+    if url is not None:
+        return {
+            name: load(url.rstrip('/'), scenario, request_count, concurrency)
+            for name, scenario in get_scenarios(movie_count).items()
+        }
+    with LocalServer() as server:
+        return {
+            name: load(server.url, scenario, request_count, concurrency, server.query_counter)
+            for name, scenario in get_scenarios(movie_count).items()
+        }
@@ -0,0 +1,62 @@
+import datetime as dt
+import itertools
+import time
+from typing import Callable, Dict, Union
+from django.db import connection
+from django.http import JsonResponse
+from django.test.utils import CaptureQueriesContext
+from api import serialization
+from api.models import Movie, Comment
+from benchmarks.stats import summarize_durations
+
+
+def measure(function: Callable[[], object], iterations: int, warmup: int = 1) -> Dict[str, Union[int, float]]:
+    """Time iterations calls of function (after warmup ones), with the number of queries per call."""
+    for _ in range(warmup):
+        function()
+    durations = []
+    with CaptureQueriesContext(connection) as queries:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+    return {'iterations': iterations, 'queries_per_call': len(queries) / iterations, **summarize_durations(durations)}
+
+
+def run(iterations: int) -> Dict[str, dict]:
+    today = dt.date.today()
+    movies = list(Movie.objects.prefetch_related('genres')[:1000])
+    comments = list(Comment.objects.all()[:1000])
+    titles = (f'benchmark title {index}' for index in itertools.count())
+    return {
+        'top_last_30_days': measure(
+            lambda: Movie.objects.all().top((today - dt.timedelta(days=30)).isoformat(), today.isoformat()),
+            iterations
+        ),
+        'top_last_year_max_rank_10': measure(
+            lambda: Movie.objects.all().top((today - dt.timedelta(days=365)).isoformat(), today.isoformat(), 10),
+            iterations
+        ),
+        f'movie_to_dict_x{len(movies)}': measure(lambda: [movie.to_dict() for movie in movies], iterations),
+        f'comment_to_dict_x{len(comments)}': measure(lambda: [comment.to_dict() for comment in comments], iterations),
+        # fetching and encoding included, unlike the to_dict benchmarks above
+        'to_dict_movies_x1000': measure(
+            lambda: JsonResponse(
+                [movie.to_dict() for movie in Movie.objects.prefetch_related('genres')[:1000]], safe=False
+            ),
+            iterations
+        ),
+        'serialize_movies_x1000': measure(
+            lambda: serialization.encode_json(serialization.serialize(Movie.objects.all()[:1000])), iterations
+        ),
+        'serialize_comments_x1000': measure(
+            lambda: serialization.encode_json(serialization.serialize(Comment.objects.all()[:1000])), iterations
+        ),
+        # a new title every time, so that the movie gets created rather than served from the TMDb cache
+        'update_or_create_from_tmdb': measure(
+            lambda: Movie.objects.update_or_create_from_tmdb(next(titles)), iterations
+        ),
+        'update_or_create_from_tmdb_unchanged': measure(
+            lambda: Movie.objects.update_or_create_from_tmdb('benchmark title'), iterations
+        )
+    }
@@ -0,0 +1,144 @@
+import datetime as dt
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, Tuple
+from django.conf import settings
+from api import sqlite
+from benchmarks.stats import summarize_durations
+
+# returns a connection for a single operation and a function releasing it afterwards
+Connect = Callable[[bool], Tuple[sqlite3.Connection, Callable[[], None]]]
+
+
+def copy_database(source: sqlite3.Connection, path: str, journal_mode: str):
+    target = sqlite3.connect(path)
+    source.backup(target)
+    target.execute(f'PRAGMA journal_mode = {journal_mode}')
+    target.close()
+
+
+def connect_per_operation(path: str) -> Connect:
+    """SQLite's defaults with a new connection per operation, like without persistent connections."""
+
+    def connect(read_only: bool) -> Tuple[sqlite3.Connection, Callable[[], None]]:
+        connection = sqlite3.connect(path, timeout=5)
+        return connection, connection.close
+
+    return connect
+
+
+def connect_persistent(path: str) -> Connect:
+    """The configured SQLite profile, with a persistent connection per thread and read-only ones for reads."""
+    local = threading.local()
+
+    def connect(read_only: bool) -> Tuple[sqlite3.Connection, Callable[[], None]]:
+        key = 'read_only' if read_only else 'read_write'
+        connection = getattr(local, key, None)
+        if connection is None:
+            if read_only:
+                connection = sqlite3.connect(f'file:{urllib.parse.quote(path)}?mode=ro', uri=True, timeout=5)
+            else:
+                connection = sqlite3.connect(path, timeout=5)
+            for statement in sqlite.get_pragma_statements(settings.SQLITE_PRAGMAS, read_only):
+                connection.execute(statement)
+            setattr(local, key, connection)
+        return connection, lambda: None
+
+    return connect
+
+
+def read_comments(connection: sqlite3.Connection, rng: random.Random, movie_count: int):
+    connection.execute(
+        'SELECT id, created_at, movie_id, text FROM api_comment WHERE movie_id = ? ORDER BY created_at, id LIMIT 100',
+        (rng.randint(1, min(movie_count, 20)),)
+    ).fetchall()
+
+
+def write_comment(connection: sqlite3.Connection, rng: random.Random, movie_count: int):
+    """Add a comment and bump its daily count, like Comment.save does."""
+    movie_id = rng.randint(1, movie_count)
+    now = dt.datetime.now(dt.timezone.utc)
+    with connection:
+        connection.execute(
+            'INSERT INTO api_comment (created_at, movie_id, text) VALUES (?, ?, ?)',
+            (now.isoformat(), movie_id, 'Tremendous')
+        )
+        if not connection.execute(
+                'UPDATE api_commentdailycount SET count = count + 1 WHERE movie_id = ? AND day = ?',
+                (movie_id, now.date().isoformat())
+        ).rowcount:
+            connection.execute(
+                'INSERT INTO api_commentdailycount (movie_id, day, count) VALUES (?, ?, 1)',
+                (movie_id, now.date().isoformat())
+            )
+
+
+def work(
+        connect: Connect, operation: Callable, read_only: bool, deadline: float, movie_count: int, seed: int,
+        durations: List[float], errors: List[float]
+):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            connection, release = connect(read_only)
+            try:
+                operation(connection, rng, movie_count)
+            finally:
+                release()
+        except sqlite3.OperationalError:
+            # "database is locked" once the busy timeout runs out
+            errors.append(time.perf_counter() - start)
+        else:
+            durations.append(time.perf_counter() - start)
+
+
+def measure(connect: Connect, duration: float, readers: int, writers: int, movie_count: int) -> Dict[str, dict]:
+    """Run readers reading threads and writers writing threads against the database for duration seconds."""
+    deadline = time.monotonic() + duration
+    results = {'reads': ([], []), 'writes': ([], [])}
+    threads = [
+        threading.Thread(target=work, args=(
+            connect, read_comments, True, deadline, movie_count, index, *results['reads']
+        ))
+        for index in range(readers)
+    ] + [
+        threading.Thread(target=work, args=(
+            connect, write_comment, False, deadline, movie_count, readers + index, *results['writes']
+        ))
+        for index in range(writers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        kind: {
+            'operations': len(durations), 'errors': len(errors), 'throughput_ops': len(durations) / duration,
+            **summarize_durations(durations)
+        }
+        for kind, (durations, errors) in results.items()
+    }
+
+
+def run(
+        source: sqlite3.Connection, directory: str, movie_count: int, duration: float, readers: int, writers: int
+) -> Dict[str, dict]:
+    """Compare concurrent read/write throughput of SQLite's defaults and of the configured profile.
+
+    Each runs against its own copy of the seeded database, with raw connections, so that only SQLite is measured.
+    """
+    results = {}
+    for name, journal_mode, connect_to in (
+            ('defaults', 'delete', connect_per_operation),
+            ('profile', settings.SQLITE_PRAGMAS.get('journal_mode', 'delete'), connect_persistent)
+    ):
+        path = os.path.join(directory, f'sqlite_{name}.sqlite3')
+        copy_database(source, path, journal_mode)
+        for kind, metrics in measure(connect_to(path), duration, readers, writers, movie_count).items():
+            results[f'{name}_{kind}'] = metrics
+    return results
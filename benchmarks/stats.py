@@ -0,0 +1,22 @@
+import math
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def summarize_durations(durations: List[float]) -> Dict[str, float]:
+    """Summarize durations in seconds as milliseconds."""
+    if not durations:
+        return {}
+    durations = sorted(durations)
+    return {
+        'min_ms': durations[0] * 1000,
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'p50_ms': percentile(durations, 0.5) * 1000,
+        'p95_ms': percentile(durations, 0.95) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'max_ms': durations[-1] * 1000
+    }
@@ -0,0 +1,34 @@
+"""Gunicorn configuration for serving MovieProxy in production.
+
+Serves movieproxy.wsgi with threaded workers by default, or movieproxy.asgi with Uvicorn workers if SERVER_MODE
+is asgi, which keeps many TMDb requests in flight per worker when adding movies in bulk. Send SIGHUP to the master
+process to restart workers gracefully.
+"""
+import multiprocessing
+import os
+
+ASGI = os.getenv('SERVER_MODE') == 'asgi'
+
+wsgi_app = 'movieproxy.asgi:application' if ASGI else 'movieproxy.wsgi:application'
+bind = f'0.0.0.0:{os.getenv("PORT", "8000")}'
+
+# one worker process per core (plus one to cover workers blocked on I/O), each serving requests with a few threads
+# when threaded – Uvicorn workers serve them concurrently on an event loop instead, and ignore threads
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+worker_class = 'uvicorn_worker.UvicornWorker' if ASGI else 'gthread'
+threads = int(os.getenv('WEB_THREADS', 4))
+
+# keep connections from load balancers alive across requests, as long as idle timeouts allow
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+
+# recycle workers every so often to contain leaks, staggered so that they don't all restart at once
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# heartbeat files in memory rather than on a possibly slow container filesystem
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = '-'
+errorlog = '-'
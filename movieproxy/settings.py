@@ -1,4 +1,5 @@
 import os
+import urllib.parse
 import dj_database_url
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -17,6 +18,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that its timings include the other middleware
+    'api.instrumentation.InstrumentationMiddleware',
+    'api.routing.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware'
@@ -39,6 +43,31 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'movieproxy.wsgi.application'
+ASGI_APPLICATION = 'movieproxy.asgi.application'
+
+# SQLite profile, used without DATABASE_URL – tuned (for single-node deployments) or default (SQLite's own defaults,
+# with a new connection per request)
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'tuned')
+
+if SQLITE_PROFILE == 'tuned':
+    # applied to every new SQLite connection
+    SQLITE_PRAGMAS = {
+        # readers and the writer don't block each other
+        'journal_mode': 'wal',
+        # syncs at checkpoints rather than at every commit – still safe against corruption, as WAL is
+        'synchronous': 'normal',
+        # milliseconds to wait for the write lock before failing with "database is locked"
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),
+        # page cache per connection, negative meaning KiB
+        'cache_size': -int(os.getenv('SQLITE_CACHE_SIZE', 64 * 1024)),
+        # bytes of the database file read through memory mapping rather than read calls
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        'temp_store': 'memory'
+    }
+elif SQLITE_PROFILE == 'default':
+    SQLITE_PRAGMAS = {}
+else:
+    raise ValueError(f'unknown SQLite profile {SQLITE_PROFILE!r}')
 
 if os.environ.get('DATABASE_URL'):
     DATABASES = {
@@ -48,9 +77,152 @@ else:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': os.path.join(BASE_DIR, 'db.sqlite3')
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            # persistent connections, keeping their caches and memory maps warm
+            'CONN_MAX_AGE': 600 if SQLITE_PROFILE == 'tuned' else 0
+        }
+    }
+    if SQLITE_PROFILE == 'tuned' and os.getenv('SQLITE_READ_ONLY_CONNECTIONS'):
+        # the same file, opened read-only for the GET views (see DATABASE_REPLICAS)
+        DATABASES['readonly'] = {
+            **DATABASES['default'],
+            'NAME': f"file:{urllib.parse.quote(DATABASES['default']['NAME'])}?mode=ro",
+            'READ_ONLY': True,
+            'TEST': {'MIRROR': 'default'}
+        }
+
+# primary keys of models without an explicit one, as in the existing migrations
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# Read replicas – every other <NAME>_DATABASE_URL adds a replica with alias <name>, which the GET views read from
+
+DATABASE_REPLICAS = ['readonly'] if 'readonly' in DATABASES else []
+
+for variable, url in sorted(os.environ.items()):
+    if variable.endswith('_DATABASE_URL') and variable != 'DEFAULT_DATABASE_URL':
+        alias = variable[:-len('_DATABASE_URL')].lower()
+        # tests run against the primary's test database
+        DATABASES[alias] = {**dj_database_url.parse(url, conn_max_age=600), 'TEST': {'MIRROR': 'default'}}
+        DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['api.routing.ReplicaRouter']
+
+# replica picked per request – REPLICA_SELECTION is one of: round_robin, least_latency
+REPLICA_SELECTION = os.getenv('REPLICA_SELECTION', 'round_robin')
+# seconds for which an unreachable replica is skipped, reading from the other replicas or the primary instead
+REPLICA_RETRY_INTERVAL = float(os.getenv('REPLICA_RETRY_INTERVAL', 30))
+# seconds for which a client reads from the primary after writing, so that it sees its own writes – 0 by default
+# without replicas other than the read-only SQLite connections, which never lag behind
+READ_YOUR_WRITES_WINDOW = int(os.getenv(
+    'READ_YOUR_WRITES_WINDOW', 5 if any(alias != 'readonly' for alias in DATABASE_REPLICAS) else 0
+))
+
+# seconds after which the in-process genre registry is reloaded, to pick up genre changes made by other processes
+GENRE_REGISTRY_MAX_AGE = float(os.getenv('GENRE_REGISTRY_MAX_AGE', 60 * 60))
+
+# TMDb API client
+
+TMDB_CLIENT = {
+    # only needed once TMDb is called, so that migrating and tests don't depend on it
+    'API_KEY': os.getenv('TMDB_API_KEY', ''),
+    'BASE_URL': os.getenv('TMDB_API_BASE_URL', 'https://api.themoviedb.org/3'),
+    'POOL_SIZE': int(os.getenv('TMDB_POOL_SIZE', 10)),
+    # whether async code looks movies up with the async client, which keeps many requests in flight from a single
+    # thread – only when served over ASGI, as over WSGI every request runs on an event loop of its own, which the
+    # client's connections wouldn't outlive (see gunicorn.conf.py)
+    'ASYNC': os.getenv('SERVER_MODE') == 'asgi',
+    'ASYNC_POOL_SIZE': int(os.getenv('TMDB_ASYNC_POOL_SIZE', 100)),
+    'CONNECT_TIMEOUT': float(os.getenv('TMDB_CONNECT_TIMEOUT', 3.05)),
+    'READ_TIMEOUT': float(os.getenv('TMDB_READ_TIMEOUT', 10)),
+    'MAX_RETRIES': int(os.getenv('TMDB_MAX_RETRIES', 3)),
+    'BACKOFF_FACTOR': float(os.getenv('TMDB_BACKOFF_FACTOR', 0.5)),
+    'MAX_BACKOFF': float(os.getenv('TMDB_MAX_BACKOFF', 30)),
+    'CIRCUIT_BREAKER_THRESHOLD': int(os.getenv('TMDB_CIRCUIT_BREAKER_THRESHOLD', 5)),
+    'CIRCUIT_BREAKER_COOLDOWN': float(os.getenv('TMDB_CIRCUIT_BREAKER_COOLDOWN', 30)),
+    # maximum requests per second per process, 0 for no limit
+    'RATE_LIMIT': float(os.getenv('TMDB_RATE_LIMIT', 40))
+}
+
+# TMDb lookup cache – BACKEND is one of: memory, django (the default Django cache), database, none
+
+TMDB_CACHE = {
+    'BACKEND': os.getenv('TMDB_CACHE_BACKEND', 'memory'),
+    'TTL': int(os.getenv('TMDB_CACHE_TTL', 24 * 60 * 60)),
+    'NEGATIVE_TTL': int(os.getenv('TMDB_CACHE_NEGATIVE_TTL', 60 * 60)),
+    'MAX_SIZE': int(os.getenv('TMDB_CACHE_MAX_SIZE', 10000))
+}
+
+# Response cache of GET endpoints – RESPONSE_CACHE_BACKEND is one of: none, memory (per process, so only suitable for
+# a single process), file (at RESPONSE_CACHE_LOCATION), database (run `manage.py createcachetable` first)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+}
+
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'none')
+
+if RESPONSE_CACHE_BACKEND == 'memory':
+    CACHES['responses'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses'
+    }
+elif RESPONSE_CACHE_BACKEND == 'file':
+    CACHES['responses'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('RESPONSE_CACHE_LOCATION', os.path.join(BASE_DIR, '.response_cache'))
+    }
+elif RESPONSE_CACHE_BACKEND == 'database':
+    CACHES['responses'] = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'api_response_cache'
+    }
+
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 10 * 60))
+
+# POST /comments ingestion – MODE is one of: direct (a transaction per comment), deferred (queued for a group commit,
+# responding 202 right away) or group_commit (queued for a group commit, responding 201 once committed)
+
+COMMENT_INGESTION = {
+    'MODE': os.getenv('COMMENT_INGESTION_MODE', 'direct'),
+    # a batch is written once it has MAX_BATCH_SIZE comments or MAX_DELAY seconds after its first comment
+    'MAX_BATCH_SIZE': int(os.getenv('COMMENT_INGESTION_MAX_BATCH_SIZE', 500)),
+    'MAX_DELAY': float(os.getenv('COMMENT_INGESTION_MAX_DELAY', 0.05)),
+    # beyond QUEUE_SIZE queued comments, requests wait up to ENQUEUE_TIMEOUT seconds for space before a 503
+    'QUEUE_SIZE': int(os.getenv('COMMENT_INGESTION_QUEUE_SIZE', 10000)),
+    'ENQUEUE_TIMEOUT': float(os.getenv('COMMENT_INGESTION_ENQUEUE_TIMEOUT', 1)),
+    # seconds to wait for queued comments to be written when the process exits
+    'SHUTDOWN_TIMEOUT': float(os.getenv('COMMENT_INGESTION_SHUTDOWN_TIMEOUT', 10))
+}
+
+# JSON encoder of list responses – JSON_BACKEND is one of: stdlib (the same output as the other responses),
+# orjson (faster, but compact and without escaping non-ASCII characters), auto (orjson if installed, else stdlib)
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'stdlib')
+
+# Share of requests whose database, TMDb and JSON encoding time is broken down in a Server-Timing header, a log line
+# and the /metrics histograms – the total time of every request is measured regardless. The log line is at DEBUG
+# level, so it is only written with INSTRUMENTATION_LOG_LEVEL=DEBUG
+
+INSTRUMENTATION_SAMPLE_RATE = float(os.getenv('INSTRUMENTATION_SAMPLE_RATE', 0.01))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler'
+        }
+    },
+    'loggers': {
+        'api.instrumentation': {
+            'handlers': ['console'],
+            'level': os.getenv('INSTRUMENTATION_LOG_LEVEL', 'INFO'),
+            'propagate': False
         }
     }
+}
 
 
 LANGUAGE_CODE = 'en-us'
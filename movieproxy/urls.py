@@ -18,7 +18,10 @@ from api import views
 
 urlpatterns = [
     path('', views.welcome, name='welcome'),
+    path('health', views.health, name='health'),
+    path('metrics', views.metrics, name='metrics'),
     path('movies', views.movies, name='movies'),
+    path('movies/bulk', views.movies_bulk, name='movies_bulk'),
     path('comments', views.comments, name='comments'),
     path('top', views.top, name='top')
 ]